@@ -0,0 +1,365 @@
+#!/usr/bin/python
+
+"""
+Benchmarks of the client against the fake netbox server.
+
+Each benchmark runs in its own process, so that its peak memory is
+measured alone, and reports its duration, throughput, p50 and p99
+latencies, peak RSS and number of requests as json:
+
+    python benchmarks/bench.py --devices 100000 --output 0.2.json
+    python benchmarks/bench.py --compare 0.2.json --tolerance 0.2
+
+With --compare, the results are checked against a previous run and the
+exit status is 1 if a benchmark got slower, or used more memory, by more
+than the tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from netboxapi_client.netboxapi_client import Api, get_list, iter_list, \
+    create, get, update, patch, delete, get_many
+
+
+def percentile(values, fraction):
+    """percentile
+
+    Returns the value below which fraction of the values are.
+
+    :param values: sorted list of numbers
+    :param fraction: float, between 0 and 1
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Measure(object):
+    """Measure
+
+    Times the operations of a benchmark and counts the requests they
+    send, through the hooks of the Api object.
+    """
+
+    def __init__(self, api=None):
+        self.latencies = []
+        self.requests = 0
+        self.errors = 0
+        self.items = 0
+        self.start = None
+        self.duration = None
+        if api is not None:
+            api.add_hook('post_request', self.record)
+
+    def record(self, method, url, reply, elapsed, error):
+        self.requests += 1
+        if reply is None or reply.status_code >= 500:
+            self.errors += 1
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.duration = default_timer() - self.start
+
+    def time(self, func, *args, **kwargs):
+        """time
+
+        Calls func and records how long it took. Returns its result.
+        """
+        start = default_timer()
+        res = func(*args, **kwargs)
+        self.latencies.append(default_timer() - start)
+        self.items += 1
+        return res
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        return {
+            'duration': self.duration,
+            'items': self.items,
+            'throughput': self.items / self.duration if self.duration else None,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'requests': self.requests,
+            'errors': self.errors,
+            # kilobytes on linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+# === Benchmarks
+#
+# Each one takes the url of the server and the options, and returns a
+# Measure.
+#
+def bench_get_list(url, opts):
+    api = Api(url=url, token='x')
+    with Measure(api) as m:
+        for _ in xrange(opts.repeat):
+            m.time(get_list, api, 'dcim', 'devices')
+    return m
+
+def bench_iter_list(url, opts):
+    api = Api(url=url, token='x')
+    with Measure(api) as m:
+        for elmt in iter_list(api, 'dcim', 'devices', page_size=1000):
+            m.items += 1
+    return m
+
+def bench_iter_list_workers(url, opts):
+    api = Api(url=url, token='x', pool_maxsize=opts.workers)
+    with Measure(api) as m:
+        for elmt in iter_list(api, 'dcim', 'devices', page_size=1000,
+                              workers=opts.workers):
+            m.items += 1
+    return m
+
+def bench_iter_list_interfaces(url, opts):
+    api = Api(url=url, token='x', pool_maxsize=opts.workers)
+    with Measure(api) as m:
+        for elmt in iter_list(api, 'dcim', 'interfaces', page_size=1000,
+                              workers=opts.workers):
+            m.items += 1
+    return m
+
+def bench_get_id_by_name(url, opts):
+    # Without name cache, each lookup goes to the server
+    api = Api(url=url, token='x', name_cache_size=0)
+    rand = random.Random(0)
+    with Measure(api) as m:
+        for _ in xrange(opts.repeat):
+            m.time(
+                api.get_id_by_name, 'dcim/devices',
+                'device{}'.format(rand.randint(1, opts.devices))
+            )
+    return m
+
+def bench_get_id_by_name_cached(url, opts):
+    api = Api(url=url, token='x')
+    rand = random.Random(0)
+    names = ['device{}'.format(rand.randint(1, opts.devices))
+             for _ in xrange(10)]
+    with Measure(api) as m:
+        for i in xrange(opts.repeat):
+            m.time(api.get_id_by_name, 'dcim/devices', names[i % 10])
+    return m
+
+def bench_get_many(url, opts):
+    api = Api(url=url, token='x', pool_maxsize=opts.workers)
+    rand = random.Random(0)
+    idents = [rand.randint(1, opts.devices) for _ in xrange(opts.repeat * 25)]
+    with Measure(api) as m:
+        m.items = len(get_many(api, 'dcim', 'devices', idents=idents,
+                               workers=opts.workers))
+    return m
+
+def bench_crud(url, opts):
+    api = Api(url=url, token='x')
+    with Measure(api) as m:
+        for i in xrange(opts.repeat):
+            name = 'bench{}'.format(i)
+            res = m.time(create, api, 'dcim', 'sites',
+                         {'name': name, 'slug': name})
+            if 'id' not in res:
+                # Creations failing on injected errors are not retried
+                continue
+            m.time(get, api, 'dcim', 'sites', ident=res['id'])
+            m.time(patch, api, 'dcim', 'sites', {'description': 'b'},
+                   ident=res['id'])
+            m.time(update, api, 'dcim', 'sites', {'name': name, 'slug': name},
+                   ident=res['id'])
+            m.time(delete, api, 'dcim', 'sites', name=name)
+    return m
+
+def bench_cli_startup(url, opts):
+    env = dict(
+        os.environ, NETBOXAPI_URL=url, NETBOXAPI_TOKEN='x',
+        XDG_CACHE_HOME=os.path.join(opts.workdir, 'cache'),
+        PYTHONPATH=os.path.dirname(HERE)
+    )
+    command = [
+        sys.executable, '-c',
+        'import sys; sys.argv[0] = "netboxapi-client"; '
+        'from netboxapi_client import main; main()',
+        'dcim', 'devices', 'show', '-i', '1'
+    ]
+    with open(os.devnull, 'w') as devnull:
+        # Fills the schema cache
+        subprocess.check_call(command[:3] + ['--refresh-schema'], env=env,
+                              cwd=opts.workdir, stdout=devnull,
+                              stderr=devnull)
+        with Measure() as m:
+            for _ in xrange(max(1, opts.repeat // 10)):
+                m.time(subprocess.check_call, command, env=env,
+                       cwd=opts.workdir, stdout=devnull, stderr=devnull)
+    return m
+
+BENCHMARKS = dict(
+    (name[len('bench_'):], func) for name, func in globals().items()
+    if name.startswith('bench_')
+)
+
+# Values for which a higher number is a regression
+LOWER_IS_BETTER = ('duration', 'p50', 'p99', 'peak_rss_kb', 'requests')
+
+
+def start_server(opts):
+    """start_server
+
+    Starts the fake netbox server in another process and returns it, with
+    its url.
+    """
+    server = subprocess.Popen([
+        sys.executable, os.path.join(HERE, 'fake_netbox.py'),
+        '--devices', str(opts.devices),
+        '--interfaces-per-device', str(opts.interfaces_per_device),
+        '--latency', str(opts.latency),
+        '--jitter', str(opts.jitter),
+        '--error-rate', str(opts.error_rate),
+        '--error-status', str(opts.error_status),
+    ], stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    return server, "http://127.0.0.1:{}".format(port)
+
+def run_one(name, url, opts):
+    """run_one
+
+    Runs a benchmark in a child process and returns its result.
+    """
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--child', name,
+        '--url', url,
+    ] + opts.forward)
+    return json.loads(output)
+
+def compare(results, baseline, tolerance):
+    """compare
+
+    Returns the list of the values of results that are worse than the
+    ones of baseline by more than tolerance.
+    """
+    regressions = []
+    for name, res in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        for key in LOWER_IS_BETTER:
+            if res.get(key) is None or not base.get(key):
+                continue
+            change = float(res[key]) / base[key] - 1
+            if change > tolerance:
+                regressions.append({
+                    'benchmark': name, 'value': key,
+                    'baseline': base[key], 'current': res[key],
+                    'change': change
+                })
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of netboxapi_client against a fake netbox."
+    )
+    parser.add_argument('--devices', type=int, default=10000,
+                        help="Number of devices of the data set.")
+    parser.add_argument('--interfaces-per-device', type=int, default=4,
+                        dest='interfaces_per_device')
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Mean delay added by the server, in ms.")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="Standard deviation of the delay, in ms.")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        dest='error_rate',
+                        help="Fraction of the requests failing.")
+    parser.add_argument('--error-status', type=int, default=503,
+                        dest='error_status',
+                        help="Status of the failed requests (503 by default, "
+                        "429 to have all methods retried).")
+    parser.add_argument('--repeat', type=int, default=200,
+                        help="Number of operations of the latency benchmarks.")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--only', type=str,
+                        help="Comma separated benchmarks to run, among {}.".format(
+                            ', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--label', type=str,
+                        help="Label of the run, such as a release number.")
+    parser.add_argument('--output', type=str,
+                        help="File to write the results to (stdout by default).")
+    parser.add_argument('--compare', type=str,
+                        help="Results of a previous run to compare with.")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--child', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--url', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', type=str, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+    if opts.workdir is None:
+        opts.workdir = tempfile.mkdtemp(prefix='netboxapi-bench')
+    opts.forward = [
+        '--devices', str(opts.devices), '--repeat', str(opts.repeat),
+        '--workers', str(opts.workers), '--workdir', opts.workdir,
+    ]
+
+    if opts.child:
+        res = BENCHMARKS[opts.child](opts.url, opts).result()
+        sys.stdout.write(json.dumps(res))
+        return
+
+    names = sorted(BENCHMARKS)
+    if opts.only:
+        names = opts.only.split(',')
+    server, url = start_server(opts)
+    results = {}
+    try:
+        for name in names:
+            sys.stderr.write("{}...\n".format(name))
+            results[name] = run_one(name, url, opts)
+    finally:
+        server.terminate()
+
+    report = {
+        'label': opts.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'config': {
+            'devices': opts.devices,
+            'interfaces_per_device': opts.interfaces_per_device,
+            'latency': opts.latency,
+            'jitter': opts.jitter,
+            'error_rate': opts.error_rate,
+            'error_status': opts.error_status,
+            'repeat': opts.repeat,
+            'workers': opts.workers,
+        },
+        'results': results,
+    }
+    status = 0
+    if opts.compare:
+        with open(opts.compare) as fd:
+            report['regressions'] = compare(
+                results, json.load(fd), opts.tolerance
+            )
+        status = 1 if report['regressions'] else 0
+    content = json.dumps(report, indent=4, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as fd:
+            fd.write(content + "\n")
+    else:
+        sys.stdout.write(content + "\n")
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
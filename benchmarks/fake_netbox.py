@@ -0,0 +1,517 @@
+#!/usr/bin/python
+
+"""
+Stand-in for a netbox server, serving synthetic data sets.
+
+Objects are generated from their id when they are read, so that data
+sets of millions of devices and interfaces take no memory: only the
+objects created, changed or deleted are stored. The api behaves like
+netbox as far as the client is concerned: pagination with count and
+next links, limit capped by MAX_PAGE_SIZE, name/slug/id/id__in/id__gt/
+last_updated__gte filters, brief and fields parameters, bulk writes,
+ETag and conditional requests. Latency and errors can be injected.
+
+    python benchmarks/fake_netbox.py --devices 100000 --latency 5
+
+The port listened on is written on the first line of stdout.
+"""
+
+import argparse
+import bisect
+import json
+import random
+import re
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urllib import urlencode
+from urlparse import urlparse, parse_qs
+
+API_VERSION = '3.7'
+BASE_DATE = '2020-01-01T00:00:00Z'
+STATUSES = (('active', 'Active'), ('planned', 'Planned'), ('offline', 'Offline'))
+
+
+class Table(object):
+    """Table
+
+    Objects of an endpoint: size generated ones, with ids 1 to size, plus
+    the ones created since. Generated objects are only stored once
+    changed.
+    """
+
+    def __init__(self, endpoint, size, generate):
+        """__init__
+
+        :param endpoint: string, 'app/endpoint'
+        :param size: int, number of generated objects
+        :param generate: function returning the generated object of an id
+        """
+        self.endpoint = endpoint
+        self.size = size
+        self.generate = generate
+        self.changed = {}
+        self.created = []
+        self.deleted = []
+        self.next_id = size + 1
+        self.lock = threading.Lock()
+
+    def exists(self, ident):
+        if ident in self.changed:
+            return True
+        if ident < 1 or ident > self.size:
+            return False
+        i = bisect.bisect_left(self.deleted, ident)
+        return i == len(self.deleted) or self.deleted[i] != ident
+
+    def get(self, ident):
+        if ident in self.changed:
+            return self.changed[ident]
+        if not self.exists(ident):
+            return None
+        return self.generate(ident)
+
+    def count(self):
+        return self.size - len(self.deleted) + len(self.created)
+
+    def rank(self, ident):
+        """rank
+
+        Returns the number of objects whose id is at most ident.
+        """
+        generated = max(0, min(ident, self.size))
+        return generated - bisect.bisect_right(self.deleted, generated) + \
+            bisect.bisect_right(self.created, ident)
+
+    def nth(self, n):
+        """nth
+
+        Returns the id of the nth object (from 0), in id order.
+        """
+        generated = self.size - len(self.deleted)
+        if n >= generated:
+            return self.created[n - generated]
+        # Smallest id with n + 1 live generated objects up to it
+        low, high = n + 1, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if mid - bisect.bisect_right(self.deleted, mid) >= n + 1:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    def find(self, field, value):
+        """find
+
+        Returns the ids of the objects whose field is value. Generated
+        objects are found from the number their name ends with.
+        """
+        ids = set(
+            i for i, o in self.changed.items() if unicode(o.get(field)) == value
+        )
+        match = re.search(r'(\d+)$', value)
+        if field in ('name', 'slug') and match:
+            ident = int(match.group(1))
+            if ident not in self.changed and self.exists(ident) and \
+                    unicode(self.generate(ident).get(field)) == value:
+                ids.add(ident)
+        return sorted(ids)
+
+    def put(self, ident, elmt):
+        with self.lock:
+            if ident > self.size and ident not in self.changed:
+                self.created.append(ident)
+            self.changed[ident] = elmt
+
+    def delete(self, ident):
+        with self.lock:
+            self.changed.pop(ident, None)
+            if ident > self.size:
+                self.created.remove(ident)
+            else:
+                bisect.insort(self.deleted, ident)
+
+    def new_id(self):
+        with self.lock:
+            ident = self.next_id
+            self.next_id += 1
+            return ident
+
+
+class Dataset(object):
+    """Dataset
+
+    Synthetic netbox content: tenants, sites, device roles, devices with
+    interfaces_per_device interfaces each.
+    """
+
+    def __init__(self, devices=10000, interfaces_per_device=4, base_url=''):
+        self.base_url = base_url
+        self.interfaces_per_device = interfaces_per_device
+        self.tenants = max(1, devices // 1000)
+        self.sites = max(1, devices // 100)
+        self.tables = dict((t.endpoint, t) for t in (
+            Table('tenancy/tenants', self.tenants, self.tenant),
+            Table('dcim/sites', self.sites, self.site),
+            Table('dcim/device-roles', 3, self.role),
+            Table('dcim/devices', devices, self.device),
+            Table('dcim/interfaces', devices * interfaces_per_device,
+                  self.interface),
+        ))
+
+    def url(self, endpoint, ident):
+        return "{}/api/{}/{}/".format(self.base_url, endpoint, ident)
+
+    def nested(self, endpoint, ident, **fields):
+        res = {
+            'id': ident,
+            'url': self.url(endpoint, ident),
+            'display': fields.get('name')
+        }
+        res.update(fields)
+        return res
+
+    def tenant(self, i):
+        return {
+            'id': i, 'url': self.url('tenancy/tenants', i),
+            'name': 'tenant{}'.format(i), 'slug': 'tenant{}'.format(i),
+            'display': 'tenant{}'.format(i), 'description': '',
+            'last_updated': BASE_DATE,
+        }
+
+    def site(self, i):
+        return {
+            'id': i, 'url': self.url('dcim/sites', i),
+            'name': 'site{}'.format(i), 'slug': 'site{}'.format(i),
+            'display': 'site{}'.format(i),
+            'status': {'value': 'active', 'label': 'Active'},
+            'tenant': self.nested(
+                'tenancy/tenants', i % self.tenants + 1,
+                name='tenant{}'.format(i % self.tenants + 1),
+                slug='tenant{}'.format(i % self.tenants + 1)
+            ),
+            'description': '', 'last_updated': BASE_DATE,
+        }
+
+    def role(self, i):
+        name = ('switch', 'router', 'server')[i - 1]
+        return {
+            'id': i, 'url': self.url('dcim/device-roles', i),
+            'name': name, 'slug': name, 'display': name, 'color': 'ffffff',
+            'last_updated': BASE_DATE,
+        }
+
+    def device(self, i):
+        site = i % self.sites + 1
+        tenant = i % self.tenants + 1
+        role = i % 3 + 1
+        status = STATUSES[i % len(STATUSES)]
+        return {
+            'id': i, 'url': self.url('dcim/devices', i),
+            'name': 'device{}'.format(i), 'display': 'device{}'.format(i),
+            'serial': 'SN{:08d}'.format(i), 'asset_tag': None,
+            'status': {'value': status[0], 'label': status[1]},
+            'site': self.nested('dcim/sites', site, name='site{}'.format(site),
+                                slug='site{}'.format(site)),
+            'tenant': self.nested('tenancy/tenants', tenant,
+                                  name='tenant{}'.format(tenant),
+                                  slug='tenant{}'.format(tenant)),
+            'role': self.nested('dcim/device-roles', role,
+                                name=('switch', 'router', 'server')[role - 1],
+                                slug=('switch', 'router', 'server')[role - 1]),
+            'platform': None, 'rack': None, 'position': None,
+            'primary_ip': {
+                'id': i, 'url': self.url('ipam/ip-addresses', i),
+                'family': 4, 'display': '10.{}.{}.{}/16'.format(
+                    i >> 16 & 255, i >> 8 & 255, i & 255),
+                'address': '10.{}.{}.{}/16'.format(
+                    i >> 16 & 255, i >> 8 & 255, i & 255),
+            },
+            'comments': '', 'tags': [], 'custom_fields': {},
+            'created': '2020-01-01', 'last_updated': BASE_DATE,
+        }
+
+    def interface(self, i):
+        device = (i - 1) // self.interfaces_per_device + 1
+        return {
+            'id': i, 'url': self.url('dcim/interfaces', i),
+            'name': 'eth{}'.format((i - 1) % self.interfaces_per_device),
+            'display': 'eth{}'.format((i - 1) % self.interfaces_per_device),
+            'device': self.nested('dcim/devices', device,
+                                  name='device{}'.format(device)),
+            'type': {'value': '10gbase-x-sfpp', 'label': 'SFP+ (10GE)'},
+            'enabled': True, 'mtu': None,
+            'mac_address': '00:00:{:02X}:{:02X}:{:02X}:{:02X}'.format(
+                i >> 24 & 255, i >> 16 & 255, i >> 8 & 255, i & 255),
+            'description': '', 'mode': None, 'tags': [], 'custom_fields': {},
+            'created': '2020-01-01', 'last_updated': BASE_DATE,
+        }
+
+
+def brief(elmt):
+    return dict((k, elmt[k]) for k in ('id', 'url', 'display', 'name', 'slug')
+                if k in elmt)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Handler
+
+    Answers the requests of the client for the dataset of the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Replies are written in several parts: with Nagle's algorithm, the
+    # last one would wait for the delayed ack of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, content=None, headers=None):
+        body = json.dumps(content) if content is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('API-Version', API_VERSION)
+        self.send_header('Content-Length', str(len(body)))
+        # As web servers do, so that the client does not reuse it
+        if self.headers.get('Connection', '').lower() == 'close':
+            self.send_header('Connection', 'close')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def handle_request(self, method):
+        server = self.server
+        # Read before answering, even with an error, to keep the
+        # connection usable
+        data = self.body()
+        if server.latency:
+            time.sleep(max(0, random.gauss(server.latency, server.jitter)) / 1000.0)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.reply(
+                server.error_status, {'detail': 'Injected error.'},
+                {'Retry-After': '0'}
+            )
+        url = urlparse(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        parts = [p for p in url.path.split('/') if p][1:]
+        dataset = server.dataset
+        if len(parts) < 2:
+            return self.root(parts)
+        table = dataset.tables.get('/'.join(parts[:2]))
+        if table is None:
+            return self.reply(404, {'detail': 'Not found.'})
+        if len(parts) > 2:
+            return self.single(method, table, int(parts[2]), query, data)
+        if method == 'GET':
+            return self.list(table, url.path, query, parse_qs(url.query))
+        return self.bulk(method, table, data)
+
+    def root(self, parts):
+        apps = {}
+        for endpoint in self.server.dataset.tables:
+            app, name = endpoint.split('/')
+            apps.setdefault(app, {})[name] = "{}/api/{}/".format(
+                self.server.dataset.base_url, endpoint
+            )
+        if not parts:
+            return self.reply(200, dict(
+                (app, "{}/api/{}/".format(self.server.dataset.base_url, app))
+                for app in apps
+            ))
+        if parts[0] not in apps:
+            return self.reply(404, {'detail': 'Not found.'})
+        return self.reply(200, apps[parts[0]])
+
+    def render(self, elmt, query):
+        if 'brief' in query:
+            return brief(elmt)
+        if 'fields' in query:
+            fields = query['fields'].split(',')
+            return dict((k, v) for k, v in elmt.items() if k in fields)
+        return elmt
+
+    def single(self, method, table, ident, query, data):
+        elmt = table.get(ident)
+        if elmt is None:
+            return self.reply(404, {'detail': 'Not found.'})
+        if method == 'GET':
+            etag = '"{}"'.format(elmt['last_updated'])
+            if ident in table.changed:
+                etag = '"{}"'.format(hash(json.dumps(elmt, sort_keys=True)))
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.reply(200, self.render(elmt, query), {'ETag': etag})
+        if method == 'DELETE':
+            table.delete(ident)
+            return self.reply(204)
+        elmt = self.write(table, ident, data or {}, partial=(method == 'PATCH'))
+        return self.reply(200, elmt)
+
+    def write(self, table, ident, data, partial):
+        if partial:
+            elmt = dict(table.get(ident))
+        else:
+            elmt = {'url': self.server.dataset.url(table.endpoint, ident)}
+        elmt.update(data)
+        elmt['id'] = ident
+        elmt['last_updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        table.put(ident, elmt)
+        return elmt
+
+    def list(self, table, path, query, multi):
+        limit = int(query.get('limit', 50))
+        offset = int(query.get('offset', 0))
+        max_page_size = self.server.max_page_size
+        if limit == 0 or limit > max_page_size:
+            limit = max_page_size
+        ids = None
+        # Filters given several times match any of their values
+        for field in ('name', 'slug'):
+            if field in query:
+                ids = sorted(set(
+                    i for v in multi[field] for i in table.find(field, v)
+                ))
+        if 'id' in query:
+            ids = sorted(set(int(i) for i in multi['id']))
+        if 'id__in' in query:
+            ids = sorted(int(i) for i in query['id__in'].split(','))
+        if 'last_updated__gte' in query and query['last_updated__gte'] > BASE_DATE:
+            ids = sorted(
+                i for i, o in table.changed.items()
+                if o.get('last_updated', '') >= query['last_updated__gte']
+            )
+        after = int(query.get('id__gt', 0))
+        if ids is not None:
+            ids = [i for i in ids if i > after and table.exists(i)]
+            count = len(ids)
+            page = ids[offset:offset + limit]
+        else:
+            skip = table.rank(after)
+            count = table.count() - skip
+            page = [table.nth(skip + n)
+                    for n in xrange(offset, min(count, offset + limit))]
+        nxt = None
+        if offset + limit < count:
+            nxt = "{}{}?{}".format(
+                self.server.dataset.base_url, path,
+                urlencode(dict(multi, limit=[limit], offset=[offset + limit]),
+                          True)
+            )
+        return self.reply(200, {
+            'count': count,
+            'next': nxt,
+            'previous': None,
+            'results': [self.render(table.get(i), query) for i in page]
+        })
+
+    def bulk(self, method, table, data):
+        if method == 'POST':
+            objects = data if isinstance(data, list) else [data]
+            res = [self.write(table, table.new_id(), o, False) for o in objects]
+            return self.reply(201, res if isinstance(data, list) else res[0])
+        if not isinstance(data, list):
+            return self.reply(400, {'detail': 'Expected a list.'})
+        if any(not table.exists(o.get('id')) for o in data):
+            return self.reply(400, [
+                {} if table.exists(o.get('id')) else {'id': ['Not found.']}
+                for o in data
+            ])
+        if method == 'DELETE':
+            for o in data:
+                table.delete(o['id'])
+            return self.reply(204)
+        return self.reply(200, [
+            self.write(table, o['id'], o, method == 'PATCH') for o in data
+        ])
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class FakeNetbox(ThreadingMixIn, HTTPServer):
+    """FakeNetbox
+
+    Threaded http server answering with a Dataset.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, devices=10000, interfaces_per_device=4,
+                 latency=0, jitter=0, error_rate=0, error_status=503,
+                 max_page_size=1000):
+        """__init__
+
+        :param port: int, port to listen on, 0 for any free port
+        :param devices: int, number of devices generated
+        :param interfaces_per_device: int, number of interfaces per device
+        :param latency: float, mean delay added to each request, in ms
+        :param jitter: float, standard deviation of that delay, in ms
+        :param error_rate: float, fraction of requests answered with
+        error_status
+        :param error_status: int, status of the injected errors
+        :param max_page_size: int, maximum number of objects per page
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+        self.dataset = Dataset(devices, interfaces_per_device, self.url)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_page_size = max_page_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake netbox server.")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--interfaces-per-device', type=int, default=4,
+                        dest='interfaces_per_device')
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Mean delay added to each request, in ms.")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="Standard deviation of the delay, in ms.")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        dest='error_rate',
+                        help="Fraction of the requests that fail.")
+    parser.add_argument('--error-status', type=int, default=503,
+                        dest='error_status')
+    parser.add_argument('--max-page-size', type=int, default=1000,
+                        dest='max_page_size')
+    ns = parser.parse_args()
+    server = FakeNetbox(**vars(ns))
+    sys.stdout.write("{}\n".format(server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
 #!/usr/bin/python
 
 import argparse
+import hashlib
 import json
+import logging
 import os, sys
 import pprint
-from netboxapi_client import Api, create, show, enum, delete, update, patch
+from functools import partial
+from netboxapi_client import Api, create, show, enum, delete, update, patch, bulk, \
+    group, batch, apply, DEFAULT_TIMEOUT
+from cache import SchemaCache, ResponseCache, default_cache_dir
+from metrics import Metrics
+from sync import snapshot
+from export import FORMATS, export
 import urllib3
 
 def get_configuration(path="{}/netboxapi.json".format(os.getcwd())):
@@ -19,16 +27,99 @@ def get_configuration(path="{}/netboxapi.json".format(os.getcwd())):
         with open(path) as fd:
             return json.load(fd)
     except Exception:
-        print("No configuration file found at {}. Reading environment variables NETBOXAPI_TOKEN and NETBOXAPI_URL.".format(path))
+        # Keep stdout for the results, which may be streamed to another tool
+        sys.stderr.write("No configuration file found at {}. Reading environment variables NETBOXAPI_TOKEN and NETBOXAPI_URL.\n".format(path))
         if 'NETBOXAPI_TOKEN' in os.environ and 'NETBOXAPI_URL' in os.environ:
           config = { "url": os.environ.get('NETBOXAPI_URL'), "token": os.environ.get('NETBOXAPI_TOKEN') }
           return config
         else:
-          print("Configuration not properly defined.")
+          sys.stderr.write("Configuration not properly defined.\n")
         sys.exit(254)
 
+def discover_schema(api):
+    """discover_schema
+
+    Walks the api root and the root of each app. Returns a tuple made of
+    the netbox version and a dictionnary of endpoints names by app.
+
+    :param api: Api object
+    """
+    # Basic error checks
+    first_call = api.get('')
+    if first_call.status_code != 200:
+        print('{}'.format(first_call.text))
+        sys.exit(2)
+
+    version = first_call.headers.get('API-Version')
+    schema = {}
+    for model in first_call.json().keys():
+        schema[model] = sorted(api.get(model+'/').json().keys())
+    return version, schema
+
+def get_schema(api, config, refresh=False, use_cache=True):
+    """get_schema
+
+    Returns a tuple (version, schema), from the schema cache when it holds
+    a valid entry for the api url, or by discovering the api otherwise.
+
+    :param api: Api object
+    :param config: dict, configuration (schema_cache and schema_cache_ttl
+    keys are used if present)
+    :param refresh: bool, forces discovery and rewrites the cache entry
+    :param use_cache: bool, set to False to neither read nor write the cache
+    """
+    if not use_cache:
+        return discover_schema(api)
+    if not refresh:
+        cached = load_schema(api, config)
+        if cached is not None:
+            return cached
+    cache = SchemaCache(
+        path=config.get('schema_cache'),
+        ttl=config.get('schema_cache_ttl', 86400)
+    )
+    version, schema = discover_schema(api)
+    try:
+        cache.save(api.url, version, schema)
+    except (IOError, OSError):
+        pass
+    return version, schema
+
+def load_schema(api, config):
+    """load_schema
+
+    Returns a tuple (version, schema) from the schema cache, without
+    discovering the api, or None if the cache has no valid entry.
+
+    :param api: Api object
+    :param config: dict, configuration (schema_cache and schema_cache_ttl
+    keys are used if present)
+    """
+    return SchemaCache(
+        path=config.get('schema_cache'),
+        ttl=config.get('schema_cache_ttl', 86400)
+    ).load(api.url)
+
 def main():
-    parser = argparse.ArgumentParser()
+    # The schema cache options have to be known before building the parsers
+    cache_parser = argparse.ArgumentParser(add_help=False)
+    cache_parser.add_argument(
+        "--refresh-schema",
+        action="store_true",
+        help="Discover the api again and refresh the schema cache.",
+        dest="refresh_schema"
+    )
+    cache_parser.add_argument(
+        "--no-schema-cache",
+        action="store_false",
+        help="Discover the api without reading or writing the schema cache.",
+        dest="schema_cache"
+    )
+    parser = argparse.ArgumentParser(
+        parents=[cache_parser],
+        epilog="Run 'netboxapi-client batch -h' to run many operations from one process, "
+        "and 'netboxapi-client export -h' to export endpoints to files."
+    )
 
     ## NOT IMPLEMENTED YET
     #parser.add_argument(
@@ -49,20 +140,140 @@ def main():
         if 'True' in config['insecure']:
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+    # Requests are only logged when a log file is configured
+    if 'log_file' in config:
+        logging.basicConfig(
+            filename=config['log_file'],
+            level=getattr(logging, config.get('log_level', 'DEBUG').upper())
+        )
+
+    # Replies of get requests are only kept when a ttl is configured
+    response_cache = None
+    if 'response_cache_ttl' in config:
+        response_cache = ResponseCache(
+            ttl=config['response_cache_ttl'],
+            stale_while_revalidate=config.get('response_cache_stale', 0),
+            path=config.get('response_cache', os.path.join(
+                default_cache_dir(), 'responses', hashlib.sha1(
+                    "{} {}".format(config['url'], config['token'])
+                ).hexdigest()[:12]
+            ))
+        )
+
     api = Api(
         url=config['url'],
-        token=config['token']
+        token=config['token'],
+        # Ids found by name are only kept between runs when asked for, as
+        # objects may be renamed or replaced meanwhile
+        name_cache_file=config.get('name_cache'),
+        name_cache_ttl=config.get('name_cache_ttl', 300),
+        retry=config.get('retries', 3),
+        max_in_flight=config.get('max_in_flight'),
+        timeout=config.get('timeout', DEFAULT_TIMEOUT),
+        response_cache=response_cache
     )
 
-    subparsers = parser.add_subparsers(dest='model')
+    # Statistics about the requests sent, written when exiting
+    if 'metrics' in config:
+        Metrics(api).write_at_exit(
+            path=config.get('metrics_file'), format=config['metrics']
+        )
 
-    # Basic error checks
-    first_call = api.get('')
-    if first_call.status_code != 200:
-        print('{}'.format(first_call.text))
-        sys.exit(2)
+    opts, remaining = cache_parser.parse_known_args()
+
+    # Batches do not need the schema
+    if remaining[:1] == ['batch']:
+        batch_parser = argparse.ArgumentParser(
+            prog="{} batch".format(parser.prog),
+            description="Runs the operations of a file, one json object per line such as "
+            '{"action": "patch", "model": "dcim", "obj": "devices", "name": "sw1", "data": {...}}, '
+            "and displays one result per line. Actions are show, list, create, update, patch and delete."
+        )
+        batch_parser.add_argument(
+            '-f', type=str, default='-', dest='file',
+            help="Path to the file of operations ('-' for stdin, the default)."
+        )
+        batch_parser.add_argument(
+            '-w', type=int, default=1, dest='workers',
+            help="Number of operations run at the same time."
+        )
+        ns = batch_parser.parse_args(remaining[1:])
+        failed = batch(api, file=ns.file, workers=ns.workers)
+        api.close()
+        if failed:
+            sys.exit(1)
+        return
 
-    mydict = api.get('').json()
+    # Neither do exports, which may cover several endpoints
+    if remaining[:1] == ['export']:
+        export_parser = argparse.ArgumentParser(
+            prog="{} export".format(parser.prog),
+            description="Writes all the objects of endpoints to files named after them, "
+            "such as dcim.devices.csv. An interrupted export is resumed by running it again."
+        )
+        export_parser.add_argument(
+            'endpoints', nargs='+', metavar='model/obj',
+            help="Endpoints to export, such as dcim/devices."
+        )
+        export_parser.add_argument(
+            '-d', type=str, default='.', dest='directory',
+            help="Directory of the files (the current one by default)."
+        )
+        export_parser.add_argument(
+            '--format', choices=FORMATS, default='ndjson.gz', dest='format',
+            help="Format of the files: gzip compressed json, one object per line (default), "
+            "csv or parquet (requires pyarrow), nested fields being columns such as tenant.name."
+        )
+        export_parser.add_argument(
+            '--fields', type=str, dest='fields',
+            help="Comma separated list of the fields to export, nested fields being written as tenant.name."
+        )
+        export_parser.add_argument(
+            '-b', type=int, default=1000, dest='page_size',
+            help="Number of objects per request, and between two checkpoints."
+        )
+        export_parser.add_argument(
+            '-w', type=int, default=1, dest='workers',
+            help="Number of pages fetched at the same time."
+        )
+        export_parser.add_argument(
+            '--restart', action='store_true', dest='restart',
+            help="Start interrupted exports again instead of resuming them."
+        )
+        ns = export_parser.parse_args(remaining[1:])
+        export(api, **vars(ns))
+        api.close()
+        return
+
+    # Only the parsers of the object and action named on the command line
+    # are built. The schema is read from the cache, or taken from the
+    # command line, and the api is only discovered for the complete help.
+    words = []
+    for word in remaining[:3]:
+        if word.startswith('-'):
+            break
+        words.append(word)
+    schema = None
+    if opts.refresh_schema or len(words) < 2:
+        version, schema = get_schema(
+            api, config,
+            refresh=opts.refresh_schema,
+            use_cache=opts.schema_cache
+        )
+        if opts.refresh_schema and not remaining:
+            sys.exit(0)
+    elif opts.schema_cache:
+        cached = load_schema(api, config)
+        if cached is not None:
+            schema = cached[1]
+    if schema is None:
+        schema = {words[0]: [words[1]]}
+    if words and words[0] in schema:
+        schema = {words[0]: schema[words[0]]}
+        if len(words) > 1 and words[1] in schema[words[0]]:
+            schema[words[0]] = [words[1]]
+
+    subparsers = parser.add_subparsers(dest='model')
 
     FUNCTION_MAP = {
         'show': show,
@@ -70,16 +281,36 @@ def main():
         'create': create,
         'delete': delete,
         'update': update,
-        'patch': patch
+        'patch': patch,
+        'bulk-create': partial(bulk, mode='create'),
+        'bulk-update': partial(bulk, mode='update'),
+        'bulk-patch': partial(bulk, mode='patch'),
+        'bulk-delete': partial(bulk, mode='delete'),
+        'sync': snapshot,
+        'group': group,
+        'apply': apply
     }
 
+    # Actions returning the number of objects that failed, the exit
+    # status being 1 if any did
+    FAILURE_COUNTS = (
+        'bulk-create', 'bulk-update', 'bulk-patch', 'bulk-delete', 'apply'
+    )
+
     DESCRIPTION_MAP = {
         'show': "Shows an object's data.",
-        'list': "Lists objects.",
+        'list': "Lists all objects, one json document per line.",
         'create': "Creates object.",
         'delete': "Deletes object",
         'update': "Updates object. It is required to fill all fields you want to be filled for that object.",
-        'patch': "Updates one or some fields of an object. Unlike update method, you can specify only the fiels you want to update."
+        'patch': "Updates one or some fields of an object. Unlike update method, you can specify only the fiels you want to update.",
+        'bulk-create': "Creates the objects of a file (json list or one object per line).",
+        'bulk-update': "Updates the objects of a file, selected by id or name.",
+        'bulk-patch': "Updates some fields of the objects of a file, selected by id or name.",
+        'bulk-delete': "Deletes the objects of a file, selected by id or name.",
+        'sync': "Updates the local snapshot of the objects, fetching only the ones changed since the last sync.",
+        'group': "Counts or aggregates all objects grouped by a field.",
+        'apply': "Brings the objects of a file to their desired state, only sending the fields that differ."
     }
 
     ARGUMENTS = {
@@ -106,54 +337,146 @@ def main():
           'type': str,
           'help': "Path to the json configuration file.",
           'dest': 'config'
+        },
+        'workers': {
+          'option': '-w',
+          'type': int,
+          'help': "Number of pages fetched at the same time when listing objects.",
+          'dest': 'workers'
+        },
+        'objects_file': {
+          'option': '-f',
+          'type': str,
+          'help': "Path to a file containing a json list of objects, or one json object per line ('-' for stdin).",
+          'dest': 'file'
+        },
+        'batch_size': {
+          'option': '-b',
+          'type': int,
+          'help': "Number of objects sent per request by bulk actions.",
+          'dest': 'batch_size'
+        },
+        'fields': {
+          'option': '--fields',
+          'type': str,
+          'help': "Comma separated list of the fields to show, nested fields being written as tenant.name.",
+          'dest': 'fields'
+        },
+        'brief': {
+          'option': '--brief',
+          'action': 'store_true',
+          'default': None,
+          'help': "Show the minimal representation of objects.",
+          'dest': 'brief'
+        },
+        'snapshot': {
+          'option': '--snapshot',
+          'type': str,
+          'help': "Path of the sqlite database holding the snapshot used by sync.",
+          'dest': 'snapshot'
+        },
+        'by': {
+          'option': '--by',
+          'type': str,
+          'help': "Field to group objects by, such as site.name or status.",
+          'dest': 'by'
+        },
+        'aggregate': {
+          'option': '--aggregate',
+          'action': 'append',
+          'help': "Aggregate computed per group: count, list:FIELD, distinct:FIELD or sum:FIELD (can be repeated, default count).",
+          'dest': 'aggregate'
+        },
+        'key': {
+          'option': '--key',
+          'type': str,
+          'help': "Field identifying the objects without id when applying a desired state (default name).",
+          'dest': 'key'
+        },
+        'delete_missing': {
+          'option': '--delete-missing',
+          'action': 'store_true',
+          'default': None,
+          'help': "Delete the objects missing from the desired state.",
+          'dest': 'delete_missing'
+        },
+        'dry_run': {
+          'option': '--dry-run',
+          'action': 'store_true',
+          'default': None,
+          'help': "Only show the changes needed to reach the desired state.",
+          'dest': 'dry_run'
+        },
+        'output': {
+          'option': '--output',
+          'choices': ['json', 'json-compact', 'ndjson'],
+          'help': "Display format: indented json with sorted keys (default for show), or one line per object (default for list).",
+          'dest': 'output'
         }
     }
 
-    for model in mydict.keys():
+    # Arguments only given to the commands when they are set
+    OPTIONAL_KWARGS = [
+        'workers', 'file', 'batch_size', 'fields', 'brief', 'output',
+        'snapshot', 'by', 'aggregate', 'key', 'delete_missing', 'dry_run'
+    ]
+
+    for model in sorted(schema.keys()):
         model_parser = subparsers.add_parser(
             model,
             help="{0} objects".format(model)
         )
         model_subparser = model_parser.add_subparsers(dest='object')
-        for elmt in api.get(model+'/').json():
+        for elmt in schema[model]:
             elmt_parser = model_subparser.add_parser(
                 elmt,
                 help="manage {0}".format(elmt)
             )
             action_subparser = elmt_parser.add_subparsers(dest="action")
-            for k, v in FUNCTION_MAP.items():
+            actions = FUNCTION_MAP.keys()
+            if len(words) > 2 and words[2] in FUNCTION_MAP:
+                actions = [words[2]]
+            for k in actions:
                 action_parser = action_subparser.add_parser(
                     k, help="{}".format(DESCRIPTION_MAP[k])
                 )
                 for k, arg in ARGUMENTS.items():
                     action_parser.add_argument(
                         arg['option'],
-                        type=arg['type'],
-                        help=arg['help'],
-                        dest=arg['dest'],
+                        **dict((key, value) for key, value in arg.items()
+                               if key != 'option')
                     )
 
     ns = parser.parse_args()
+    failed = 0
     if 'action' in ns:
+        kwargs = {
+            'api': api,
+            'model': ns.model,
+            'obj': ns.object,
+            'ident': ns.id,
+            'name': ns.name
+        }
+        for k in OPTIONAL_KWARGS:
+            if getattr(ns, k) is not None:
+                kwargs[k] = getattr(ns, k)
         if 'data' in ns and ns.data:
-                pprint(
-                    FUNCTION_MAP[ns.action](
-                        api=api,
-                        model=ns.model,
-                        obj=ns.object,
-                        ident=ns.id,
-                        name=ns.name,
-                        data=json.loads(ns.data)
-                    )
-                )
+                kwargs['data'] = json.loads(ns.data)
+                result = FUNCTION_MAP[ns.action](**kwargs)
+                pprint.pprint(result)
         else:
-            FUNCTION_MAP[ns.action](
-                api=api,
-                model=ns.model,
-                obj=ns.object,
-                ident=ns.id,
-                name=ns.name
-            )
+            result = FUNCTION_MAP[ns.action](**kwargs)
+        if ns.action in FAILURE_COUNTS:
+            failed = result
+
+    # Forget the cached schema if the server has been upgraded meanwhile
+    if opts.schema_cache and api.last_reply is not None:
+        SchemaCache(path=config.get('schema_cache')).check_version(
+            api.url, api.last_reply.headers.get('API-Version')
+        )
+    api.close()
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+from multiprocessing.pool import ThreadPool
+from netboxapi_client import Api, get, get_list, create, delete, update, \
+    patch
+
+
+class AsyncApi(object):
+    """AsyncApi
+
+    Sends requests to the api without blocking the caller. Requests are
+    run by a pool of concurrency threads sharing one Api object, and so
+    its connection pool. Each verb of Api has a counterpart here, which
+    returns an AsyncResult: its get() method waits for and returns the
+    Response object, or raises the exception of the request.
+    """
+
+    def __init__(self, concurrency=10, **kwargs):
+        """__init__
+
+        :param concurrency: int, maximum number of requests in flight
+        :param **kwargs: passed to Api, should contain at least 'url' and
+        'token'. pool_maxsize defaults to concurrency.
+        """
+        kwargs.setdefault('pool_maxsize', concurrency)
+        self.api = Api(**kwargs)
+        self.__pool = ThreadPool(concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """close
+
+        Waits for the pending requests, then closes the connections.
+        """
+        self.__pool.close()
+        self.__pool.join()
+        self.api.close()
+
+    def submit(self, func, *args, **kwargs):
+        """submit
+
+        Runs func(*args, **kwargs) from the pool of threads and returns an
+        AsyncResult. A callback keyword argument, if given, is called with
+        the result once it is available.
+
+        :param func: function to run
+        """
+        callback = kwargs.pop('callback', None)
+        return self.__pool.apply_async(func, args, kwargs, callback)
+
+    def get(self, path="", params="", **kwargs):
+        """get
+
+        See Api.get.
+        """
+        return self.submit(self.api.get, path, params, **kwargs)
+
+    def get_id_by_name(self, path="", name="", **kwargs):
+        """get_id_by_name
+
+        See Api.get_id_by_name.
+        """
+        return self.submit(self.api.get_id_by_name, path, name, **kwargs)
+
+    def list(self, path="", **kwargs):
+        """list
+
+        See Api.list.
+        """
+        return self.submit(self.api.list, path, **kwargs)
+
+    def post(self, path="", payload={}, **kwargs):
+        """post
+
+        See Api.post.
+        """
+        return self.submit(self.api.post, path, payload, **kwargs)
+
+    def delete(self, path="", payload=None, **kwargs):
+        """delete
+
+        See Api.delete.
+        """
+        return self.submit(self.api.delete, path, payload, **kwargs)
+
+    def put(self, path="", payload={}, **kwargs):
+        """put
+
+        See Api.put.
+        """
+        return self.submit(self.api.put, path, payload, **kwargs)
+
+    def patch(self, path="", payload={}, **kwargs):
+        """patch
+
+        See Api.patch.
+        """
+        return self.submit(self.api.patch, path, payload, **kwargs)
+
+
+# === Commands
+#
+# Counterparts of the module functions of netboxapi_client, taking an
+# AsyncApi object and returning an AsyncResult.
+#
+def get_async(api, *args, **kwargs):
+    """get_async
+
+    See netboxapi_client.get.
+    """
+    return api.submit(get, api.api, *args, **kwargs)
+
+def get_list_async(api, *args, **kwargs):
+    """get_list_async
+
+    See netboxapi_client.get_list.
+    """
+    return api.submit(get_list, api.api, *args, **kwargs)
+
+def create_async(api, *args, **kwargs):
+    """create_async
+
+    See netboxapi_client.create.
+    """
+    return api.submit(create, api.api, *args, **kwargs)
+
+def delete_async(api, *args, **kwargs):
+    """delete_async
+
+    See netboxapi_client.delete.
+    """
+    return api.submit(delete, api.api, *args, **kwargs)
+
+def update_async(api, *args, **kwargs):
+    """update_async
+
+    See netboxapi_client.update.
+    """
+    return api.submit(update, api.api, *args, **kwargs)
+
+def patch_async(api, *args, **kwargs):
+    """patch_async
+
+    See netboxapi_client.patch.
+    """
+    return api.submit(patch, api.api, *args, **kwargs)
@@ -0,0 +1,402 @@
+#!/usr/bin/python
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def default_cache_dir():
+    """default_cache_dir
+
+    Returns the directory in which the client stores its cache files.
+    Follows XDG_CACHE_HOME when it is defined.
+    """
+    base = os.environ.get(
+        'XDG_CACHE_HOME',
+        os.path.join(os.path.expanduser('~'), '.cache')
+    )
+    return os.path.join(base, 'netboxapi_client')
+
+
+def write_json_atomic(path, content):
+    """write_json_atomic
+
+    Writes content as json in path, through a temporary file, so that a
+    concurrent reader never sees a partially written file.
+
+    :param path: string, destination file
+    :param content: data to serialize
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another thread meanwhile
+            if not os.path.isdir(directory):
+                raise
+    # Unique to each call, as threads of a process may write the same path
+    fd, tmp = tempfile.mkstemp(
+        prefix="{}.".format(os.path.basename(path)), suffix='.tmp',
+        dir=directory or '.'
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f)
+        os.rename(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def read_json(path):
+    """read_json
+
+    Returns the json content of path, or None if it does not exist or
+    can't be decoded.
+
+    :param path: string, file to read
+    """
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class SchemaCache(object):
+    """SchemaCache
+
+    Keeps, on disk, the list of apps and endpoints exposed by netbox
+    instances, so that the cli can build its parsers without discovering
+    the api on each run. Entries are keyed by url and remember the netbox
+    version they were discovered on.
+    """
+
+    def __init__(self, path=None, ttl=86400):
+        """__init__
+
+        :param path: string, path of the cache file
+        :param ttl: int, seconds after which an entry has to be rediscovered
+        """
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'schema.json')
+        self.path = path
+        self.ttl = ttl
+
+    def __read(self):
+        content = read_json(self.path)
+        if not isinstance(content, dict):
+            return {}
+        return content
+
+    def load(self, url):
+        """load
+
+        Returns a tuple (version, schema) for url, or None if there is no
+        valid entry.
+
+        :param url: string, url of the netbox instance
+        """
+        entry = self.__read().get(url)
+        if not entry:
+            return None
+        if self.ttl is not None and time.time() - entry['timestamp'] > self.ttl:
+            return None
+        return entry['version'], entry['schema']
+
+    def save(self, url, version, schema):
+        """save
+
+        Stores the schema discovered for url.
+
+        :param url: string, url of the netbox instance
+        :param version: string, netbox api version (API-Version header)
+        :param schema: dict, endpoints names by app
+        """
+        content = self.__read()
+        content[url] = {
+            'version': version,
+            'timestamp': time.time(),
+            'schema': schema
+        }
+        write_json_atomic(self.path, content)
+
+    def invalidate(self, url):
+        """invalidate
+
+        Drops the entry of url, if any.
+
+        :param url: string, url of the netbox instance
+        """
+        content = self.__read()
+        if url in content:
+            del content[url]
+            write_json_atomic(self.path, content)
+
+    def check_version(self, url, version):
+        """check_version
+
+        Drops the entry of url if it was discovered on another netbox
+        version than the one given.
+
+        :param url: string, url of the netbox instance
+        :param version: string, version reported by the server
+        """
+        entry = self.__read().get(url)
+        if entry and version and entry['version'] != version:
+            self.invalidate(url)
+
+
+class LRUCache(object):
+    """LRUCache
+
+    Thread safe mapping keeping at most maxsize entries, each one for at
+    most ttl seconds. The least recently used entries are evicted first.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """__init__
+
+        :param maxsize: int, maximum number of entries, 0 disables the cache
+        :param ttl: int, seconds after which an entry expires, None to keep
+        entries until they are evicted
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __expired(self, timestamp):
+        return self.ttl is not None and time.time() - timestamp > self.ttl
+
+    def get(self, key, default=None):
+        """get
+
+        Returns the value stored for key, or default if it is absent or
+        expired.
+
+        :param key: hashable
+        :param default: returned on cache miss
+        """
+        with self.__lock:
+            if key not in self.__data:
+                return default
+            value, timestamp = self.__data.pop(key)
+            if self.__expired(timestamp):
+                return default
+            self.__data[key] = (value, timestamp)
+            return value
+
+    def set(self, key, value, timestamp=None):
+        """set
+
+        Stores value for key, evicting the least recently used entries if
+        needed.
+
+        :param key: hashable
+        :param value: any object
+        :param timestamp: float, time at which value was fetched (now by
+        default)
+        """
+        if self.maxsize <= 0:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        with self.__lock:
+            self.__data.pop(key, None)
+            self.__data[key] = (value, timestamp)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def pop(self, key):
+        """pop
+
+        Drops the entry of key, if any.
+
+        :param key: hashable
+        """
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def remove_if(self, predicate):
+        """remove_if
+
+        Drops all the entries for which predicate(key, value) is true.
+
+        :param predicate: function taking a key and a value
+        """
+        with self.__lock:
+            for key in [k for k, (v, t) in self.__data.items()
+                        if predicate(k, v)]:
+                del self.__data[key]
+
+    def clear(self):
+        """clear
+
+        Drops all the entries.
+        """
+        with self.__lock:
+            self.__data.clear()
+
+    def dump(self):
+        """dump
+
+        Returns the entries that are not expired, as a list of
+        [key, value, timestamp] lists, from the least recently used.
+        """
+        with self.__lock:
+            return [[k, v, t] for k, (v, t) in self.__data.items()
+                    if not self.__expired(t)]
+
+    def load(self, entries):
+        """load
+
+        Stores entries returned by dump. List keys are turned back into
+        tuples, since json does not know about tuples.
+
+        :param entries: list of [key, value, timestamp] lists
+        """
+        for key, value, timestamp in entries:
+            if isinstance(key, list):
+                key = tuple(key)
+            if not self.__expired(timestamp):
+                self.set(key, value, timestamp)
+
+
+class ResponseCache(object):
+    """ResponseCache
+
+    Keeps the replies of get requests, in memory and optionally on disk,
+    so that objects read again are not downloaded again. Entries are
+    dicts holding the status, a few headers and the content of a reply,
+    keyed by url and stored in groups (the endpoints) that writes
+    invalidate at once.
+
+    A reply is fresh during ttl seconds. It is then revalidated with a
+    conditional request, when it came with an ETag or Last-Modified
+    header, or fetched again. During the stale_while_revalidate seconds
+    following its expiration, it is still returned while being
+    revalidated in the background.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, path=None,
+                 stale_while_revalidate=0):
+        """__init__
+
+        :param maxsize: int, maximum number of replies kept in memory, the
+        least recently used are evicted first
+        :param ttl: int, seconds during which a reply is used without
+        asking the server
+        :param path: string, directory in which replies are also stored,
+        None to keep them in memory only. It should not be shared by
+        clients using different tokens.
+        :param stale_while_revalidate: int, seconds after ttl during which
+        a reply is still used while it is revalidated
+        """
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.path = path
+        self.__memory = LRUCache(maxsize=maxsize)
+        self.__generations = {}
+        self.__lock = threading.Lock()
+
+    def __file(self, key, group):
+        return os.path.join(
+            self.path,
+            hashlib.sha1(group.encode('utf-8')).hexdigest()[:16],
+            "{}.json".format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+        )
+
+    def age(self, entry):
+        """age
+
+        Returns the number of seconds since entry was fetched or
+        revalidated.
+
+        :param entry: dict returned by get
+        """
+        return time.time() - entry['timestamp']
+
+    def get(self, key, group):
+        """get
+
+        Returns the entry stored for key, fresh or not, or None.
+
+        :param key: string, url of the request
+        :param group: string, group of the entry
+        """
+        entry = self.__memory.get(key)
+        if entry is None and self.path is not None:
+            entry = read_json(self.__file(key, group))
+            if entry is not None:
+                self.__memory.set(key, entry)
+        return entry
+
+    def generation(self, group):
+        """generation
+
+        Returns a number that changes each time group is invalidated. It
+        is read before sending a request and given to set, so that a
+        reply fetched while the group was written to is not kept.
+
+        :param group: string, group of the entry
+        """
+        with self.__lock:
+            return self.__generations.get(group, 0)
+
+    def set(self, key, group, entry, generation=None):
+        """set
+
+        Stores entry for key, timestamped now.
+
+        :param key: string, url of the request
+        :param group: string, group of the entry
+        :param entry: dict with at least 'status', 'headers' and 'content'
+        :param generation: value returned by generation() before the
+        request was sent, if any
+        """
+        if generation is not None and generation != self.generation(group):
+            return
+        entry = dict(entry, group=group, timestamp=time.time())
+        self.__memory.set(key, entry)
+        if self.path is not None:
+            try:
+                write_json_atomic(self.__file(key, group), entry)
+            except (IOError, OSError):
+                pass
+
+    def invalidate(self, group):
+        """invalidate
+
+        Drops all the entries of group.
+
+        :param group: string, group of the entries
+        """
+        with self.__lock:
+            self.__generations[group] = self.__generations.get(group, 0) + 1
+        self.__memory.remove_if(lambda k, v: v.get('group') == group)
+        if self.path is not None:
+            shutil.rmtree(
+                os.path.dirname(self.__file('', group)), ignore_errors=True
+            )
+
+    def clear(self):
+        """clear
+
+        Drops all the entries.
+        """
+        with self.__lock:
+            for group in self.__generations:
+                self.__generations[group] += 1
+        self.__memory.clear()
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+"""
+Json encoding and decoding, through the fastest library available:
+orjson, ujson or simplejson, falling back to the json module.
+"""
+
+import json
+
+try:
+    import orjson as _backend
+    BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson as _backend
+        BACKEND = 'ujson'
+    except ImportError:
+        try:
+            import simplejson as _backend
+            BACKEND = 'simplejson'
+        except ImportError:
+            _backend = json
+            BACKEND = 'json'
+
+
+def loads(data):
+    """loads
+
+    Decodes a json document. Raises ValueError if it is malformed or
+    empty.
+
+    :param data: string or bytes, json document
+    """
+    if not data:
+        raise ValueError("No json document to decode.")
+    return _backend.loads(data)
+
+
+def dumps(obj, pretty=False):
+    """dumps
+
+    Encodes obj as a json document and returns it as a string.
+
+    :param obj: data to encode
+    :param pretty: bool, if True keys are sorted and the document is
+    indented, which is done by the json module for a stable output
+    """
+    if pretty:
+        return json.dumps(
+            obj, sort_keys=True, indent=4, separators=(',', ': ')
+        )
+    if BACKEND == 'orjson':
+        return _backend.dumps(obj).decode('utf-8')
+    if BACKEND == 'ujson':
+        return _backend.dumps(obj, escape_forward_slashes=False)
+    return _backend.dumps(obj, separators=(',', ':'))
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+"""
+Export of netbox endpoints to files, for analytics.
+
+Objects are written while their pages are read, so that exports take
+constant memory whatever the size of the endpoint. They are read by
+increasing id, and after each page the last id written and the size of
+the file are recorded in a state file next to it: an interrupted export
+is resumed from there by running it again. The state file is removed once
+the export is complete.
+"""
+
+import csv
+import gzip
+import os
+import sys
+from netboxapi_client import ApiError, iter_list, print_json, project, \
+    _field_list, _top_fields
+from cache import read_json, write_json_atomic
+from codec import dumps
+
+# Formats, which are also the extensions of the files
+FORMATS = ('ndjson.gz', 'csv', 'parquet')
+
+
+def flatten(elmt, prefix=''):
+    """flatten
+
+    Returns elmt as a flat dict: nested objects give dotted keys, such as
+    'tenant.name', and lists are encoded as json strings.
+
+    :param elmt: dict, object returned by the api
+    :param prefix: string, prepended to the keys
+    """
+    res = {}
+    for key, value in elmt.items():
+        key = u"{}{}".format(prefix, key)
+        if isinstance(value, dict) and value:
+            res.update(flatten(value, key + u'.'))
+        elif isinstance(value, (list, dict)):
+            res[key] = dumps(value)
+        else:
+            res[key] = value
+    return res
+
+
+class NdjsonWriter(object):
+    """NdjsonWriter
+
+    Writes objects as gzip compressed json, one object per line. Each
+    page is a gzip member of its own: concatenated members are a valid
+    gzip file, so an export can be resumed by appending to it.
+    """
+
+    resumable = True
+
+    def __init__(self, fd, columns=None, resume=False):
+        """__init__
+
+        :param fd: file object, opened for binary writing
+        :param columns: list of dotted paths to keep, or None for all the
+        fields
+        :param resume: bool, True if fd already holds part of the export
+        """
+        self.fd = fd
+        self.columns = columns
+        self.gz = None
+
+    def write(self, elmt):
+        if self.gz is None:
+            self.gz = gzip.GzipFile(fileobj=self.fd, mode='wb')
+        if self.columns:
+            elmt = project(elmt, self.columns)
+        line = dumps(elmt)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        self.gz.write(line + "\n")
+
+    def checkpoint(self):
+        if self.gz is not None:
+            self.gz.close()
+            self.gz = None
+        self.fd.flush()
+
+    def close(self):
+        self.checkpoint()
+
+
+class CsvWriter(object):
+    """CsvWriter
+
+    Writes flattened objects as csv, with a header line. The columns are
+    the given ones, or the ones of the first page otherwise: give them
+    when the first objects may lack some fields, such as custom fields
+    or nested objects that are null.
+    """
+
+    resumable = True
+
+    def __init__(self, fd, columns=None, resume=False):
+        """__init__
+
+        :param fd: file object, opened for binary writing
+        :param columns: list of dotted paths, or None to use the ones of
+        the first page
+        :param resume: bool, True if fd already holds part of the export,
+        header included
+        """
+        self.fd = fd
+        self.columns = columns
+        self.writer = None
+        self.pending = []
+        self.header = not resume
+
+    def __encode(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def __write_row(self, row):
+        if self.writer is None:
+            self.writer = csv.writer(self.fd)
+            if self.header:
+                self.writer.writerow(
+                    [self.__encode(c) for c in self.columns]
+                )
+        self.writer.writerow([self.__encode(row.get(c)) for c in self.columns])
+
+    def write(self, elmt):
+        row = flatten(elmt)
+        if self.columns is None:
+            # The columns are known at the end of the first page
+            self.pending.append(row)
+        else:
+            self.__write_row(row)
+
+    def checkpoint(self):
+        if self.pending:
+            self.columns = []
+            for row in self.pending:
+                self.columns.extend(
+                    sorted(c for c in row if c not in self.columns)
+                )
+            for row in self.pending:
+                self.__write_row(row)
+            self.pending = []
+        self.fd.flush()
+
+    def close(self):
+        self.checkpoint()
+
+
+class ParquetWriter(object):
+    """ParquetWriter
+
+    Writes flattened objects as parquet, one row group per page, with
+    pyarrow. The columns and their types are the ones of the first page,
+    columns without any value there being strings. Parquet files can
+    not be appended to: an interrupted export is started again.
+    """
+
+    resumable = False
+
+    def __init__(self, fd, columns=None, resume=False):
+        """__init__
+
+        :param fd: file object, opened for binary writing
+        :param columns: list of dotted paths, or None to use the ones of
+        the first page
+        :param resume: bool, ignored
+        """
+        # Only loaded when needed, as it is slow to import
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("The parquet format requires pyarrow.")
+        self.pyarrow = pyarrow
+        self.fd = fd
+        self.columns = columns
+        self.schema = None
+        self.writer = None
+        self.rows = []
+
+    def write(self, elmt):
+        self.rows.append(flatten(elmt))
+
+    def checkpoint(self):
+        if not self.rows:
+            return
+        if self.columns is None:
+            self.columns = sorted(set(c for row in self.rows for c in row))
+        data = dict(
+            (c, [row.get(c) for row in self.rows]) for c in self.columns
+        )
+        self.rows = []
+        pyarrow = self.pyarrow
+        if self.schema is None:
+            schema = pyarrow.Table.from_pydict(data).schema
+            self.schema = pyarrow.schema([
+                pyarrow.field(f.name, pyarrow.string())
+                if pyarrow.types.is_null(f.type) else f
+                for f in schema
+            ])
+            self.writer = pyarrow.parquet.ParquetWriter(self.fd, self.schema)
+        self.writer.write_table(
+            pyarrow.Table.from_pydict(data, schema=self.schema)
+        )
+
+    def close(self):
+        self.checkpoint()
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {
+    'ndjson.gz': NdjsonWriter,
+    'csv': CsvWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def export_endpoint(api, model, obj, path, format='ndjson.gz',
+                    page_size=1000, workers=1, fields=None, filters=None,
+                    restart=False):
+    """export_endpoint
+
+    Writes all the objects of an endpoint to a file, resuming the
+    previous export to the same file if it has been interrupted. Returns
+    the number of objects in the file.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param path: string, path of the file written
+    :param format: string, one of FORMATS
+    :param page_size: int, number of objects per page and per checkpoint
+    :param workers: int, number of pages fetched at the same time
+    :param fields: list of dotted paths (or comma separated string) of the
+    fields to export, all of them by default
+    :param filters: dict of netbox filters, see iter_list
+    :param restart: bool, ignores the state of an interrupted export
+    """
+    writer_class = WRITERS[format]
+    columns = _field_list(fields)
+    state_path = "{}.state".format(path)
+    state = None if restart else read_json(state_path)
+    if state is not None and (not writer_class.resumable or
+                              not os.path.exists(path)):
+        state = None
+
+    fd = open(path, 'r+b' if state else 'wb')
+    if state:
+        fd.seek(state['size'])
+        fd.truncate()
+        columns = state['columns']
+    else:
+        state = {'last_id': 0, 'count': 0, 'size': 0}
+    writer = writer_class(fd, columns, resume=state['size'] > 0)
+
+    filters = dict(filters or {})
+    filters.update({'ordering': 'id', 'id__gt': state['last_id']})
+    # The ids are needed to resume
+    asked = _top_fields(columns + ['id']) if columns else None
+    written = 0
+    try:
+        for elmt in iter_list(api, model, obj, page_size=page_size,
+                              workers=workers, fields=asked,
+                              filters=filters):
+            writer.write(elmt)
+            state['last_id'] = elmt['id']
+            state['count'] += 1
+            written += 1
+            if written % page_size == 0:
+                writer.checkpoint()
+                state['size'] = fd.tell()
+                state['columns'] = writer.columns
+                write_json_atomic(state_path, state)
+        writer.close()
+    finally:
+        fd.close()
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return state['count']
+
+
+def export(api, endpoints, directory='.', format='ndjson.gz', **kwargs):
+    """export
+
+    Exports endpoints to files named after them in a directory, such as
+    dcim.devices.csv, and displays the number of objects of each file, or
+    the error that interrupted its export.
+
+    :param api: Api object
+    :param endpoints: list of strings, 'model/obj'
+    :param directory: string, created if it does not exist
+    :param format: string, one of FORMATS
+    :param **kwargs: passed to export_endpoint
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown export format: {}".format(format))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    res = {}
+    for endpoint in endpoints:
+        model, obj = endpoint.strip('/').split('/')
+        path = os.path.join(
+            directory, "{}.{}.{}".format(model, obj, format)
+        )
+        sys.stderr.write("Exporting {} to {}\n".format(endpoint, path))
+        res[endpoint] = {'path': path}
+        try:
+            res[endpoint]['count'] = export_endpoint(
+                api, model, obj, path, format, **kwargs
+            )
+        except ApiError as e:
+            sys.stderr.write("{}\n".format(e))
+            res[endpoint]['error'] = unicode(e)
+    print_json(res)
+    return res
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+"""
+Ansible dynamic inventory built from netbox devices.
+
+Ansible runs the inventory script with --list, then with --host for each
+host unless the --list output has a _meta.hostvars entry. Both are
+answered from a cache file while it is younger than its ttl, so that
+playbook runs do not wait for netbox.
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+import time
+from netboxapi_client import Api, GroupBy, iter_list, print_json, resolve
+from cache import default_cache_dir, read_json, write_json_atomic
+from __main__ import get_configuration
+
+# Fields hosts can be grouped by
+GROUPS = ('tenant', 'site', 'role', 'platform', 'status')
+
+# Fields of the objects asked to netbox
+FIELDS = [
+    'id', 'name', 'serial', 'primary_ip.address', 'primary_ip4.address',
+    'primary_ip6.address', 'tenant.name', 'site.name', 'role.name',
+    'device_role.name', 'platform.name', 'status.value',
+]
+
+
+def group_name(prefix, value):
+    """group_name
+
+    Returns the name of an ansible group, made of lowercase letters,
+    digits and underscores only.
+
+    :param prefix: string, such as 'site'
+    :param value: value of the grouping field
+    """
+    return re.sub(
+        r'[^a-z0-9_]', '_', u"{}_{}".format(prefix, value).lower()
+    )
+
+def hostvars(elmt):
+    """hostvars
+
+    Returns the variables of a host: ansible_host is its primary ip
+    without prefix length, the others are the grouping fields, serial and
+    id of the object prefixed with netbox_.
+
+    :param elmt: dict, object returned by the api
+    """
+    res = {'netbox_id': elmt.get('id')}
+    for path in ('primary_ip', 'primary_ip4', 'primary_ip6'):
+        address = resolve(elmt, path + '.address')
+        if address:
+            res['ansible_host'] = address.split('/')[0]
+            break
+    for field in GROUPS:
+        value = resolve(elmt, field + '.name', resolve(elmt, field + '.value'))
+        if value is not None:
+            res['netbox_{}'.format(field)] = value
+    if elmt.get('serial'):
+        res['netbox_serial'] = elmt['serial']
+    return res
+
+def build_inventory(api, model='dcim', obj='devices',
+                    groups=('tenant', 'site', 'role'), workers=1):
+    """build_inventory
+
+    Returns an ansible inventory of the objects of an endpoint, read in
+    a single pass: one group per value of each grouping field, and the
+    variables of all hosts in _meta.hostvars. Objects without a name are
+    left out.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param groups: list of fields among GROUPS
+    :param workers: int, number of pages fetched at the same time
+    """
+    for field in groups:
+        if field not in GROUPS:
+            raise ValueError("Unknown inventory group: {}".format(field))
+    groupers = dict(
+        (field, GroupBy(field, {'hosts': 'list:name'})) for field in groups
+    )
+    meta = {}
+    for elmt in iter_list(api, model, obj, page_size=1000, workers=workers,
+                          fields=FIELDS):
+        if not elmt.get('name'):
+            continue
+        # Netbox < 3.6 calls it device_role
+        if elmt.get('role') is None and elmt.get('device_role') is not None:
+            elmt['role'] = elmt['device_role']
+        meta[elmt['name']] = hostvars(elmt)
+        for grouper in groupers.values():
+            grouper.add(elmt)
+
+    inventory = {'_meta': {'hostvars': meta}}
+    for field, grouper in groupers.items():
+        for value, group in grouper.result().items():
+            if value is not None:
+                inventory.setdefault(
+                    group_name(field, value), {'hosts': []}
+                )['hosts'].extend(group['hosts'])
+    inventory['all'] = {
+        'hosts': sorted(meta),
+        'children': sorted(k for k in inventory if k != '_meta'),
+    }
+    return inventory
+
+
+class InventoryCache(object):
+    """InventoryCache
+
+    Keeps the last inventory built for a netbox instance in a json file.
+    """
+
+    def __init__(self, path, ttl=300):
+        """__init__
+
+        :param path: string, path of the cache file
+        :param ttl: int, seconds during which the inventory is used
+        """
+        self.path = path
+        self.ttl = ttl
+
+    def load(self):
+        """load
+
+        Returns the cached inventory, or None if there is none or it has
+        expired.
+        """
+        content = read_json(self.path)
+        if not isinstance(content, dict) or \
+                time.time() - content.get('timestamp', 0) > self.ttl:
+            return None
+        return content['inventory']
+
+    def save(self, inventory):
+        """save
+
+        Stores an inventory.
+
+        :param inventory: dict returned by build_inventory
+        """
+        write_json_atomic(self.path, {
+            'timestamp': time.time(),
+            'inventory': inventory
+        })
+
+
+def get_inventory(api, cache=None, refresh=False, **kwargs):
+    """get_inventory
+
+    Returns the inventory from cache if it holds a valid one, builds it
+    and stores it otherwise.
+
+    :param api: Api object
+    :param cache: InventoryCache object, or None
+    :param refresh: bool, ignores the cached inventory
+    :param **kwargs: passed to build_inventory
+    """
+    if cache is not None and not refresh:
+        inventory = cache.load()
+        if inventory is not None:
+            return inventory
+    inventory = build_inventory(api, **kwargs)
+    if cache is not None:
+        try:
+            cache.save(inventory)
+        except (IOError, OSError):
+            sys.stderr.write(
+                "Could not save inventory to {}\n".format(cache.path)
+            )
+    return inventory
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ansible dynamic inventory of netbox devices."
+    )
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--list", action="store_true", dest="list",
+                      help="Show the whole inventory.")
+    mode.add_argument("--host", type=str, dest="host",
+                      help="Show the variables of a host.")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached inventory.")
+    parser.add_argument("--group-by", type=str, dest="group_by",
+                        help="Comma separated fields to group hosts by, "
+                        "among {} (default tenant,site,role).".format(
+                            ','.join(GROUPS)))
+    parser.add_argument("-c", type=str, dest="config",
+                        help="Path to the json configuration file.")
+    ns = parser.parse_args()
+
+    # Ansible runs the script from the playbook directory
+    config = get_configuration(ns.config or os.environ.get(
+        'NETBOXAPI_CONFIG', "{}/netboxapi.json".format(os.getcwd())
+    ))
+    groups = (
+        ns.group_by or config.get('inventory_groups', 'tenant,site,role')
+    ).split(',')
+    cache = InventoryCache(
+        config.get('inventory_cache', os.path.join(
+            default_cache_dir(), "inventory-{}.json".format(hashlib.sha1(
+                "{} {}".format(config['url'], ','.join(groups))
+            ).hexdigest()[:12])
+        )),
+        ttl=config.get('inventory_ttl', 300)
+    )
+    api = Api(url=config['url'], token=config['token'])
+    inventory = get_inventory(
+        api, cache, refresh=ns.refresh, groups=groups,
+        workers=config.get('inventory_workers', 1)
+    )
+    api.close()
+    if ns.host:
+        print_json(inventory['_meta']['hostvars'].get(ns.host, {}))
+    else:
+        print_json(inventory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+import atexit
+import sys
+import threading
+from urlparse import urlparse
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def endpoint_of(url):
+    """endpoint_of
+
+    Returns the path of url after /api/, without its query string, and
+    with numerical ids replaced by {id}, so that requests on different
+    objects of an endpoint are counted together.
+
+    :param url: string, complete url of a request
+    """
+    path = urlparse(url).path
+    if '/api/' in path:
+        path = path.split('/api/', 1)[1]
+    parts = [p for p in path.split('/') if p]
+    return '/'.join('{id}' if p.isdigit() else p for p in parts)
+
+
+class Metrics(object):
+    """Metrics
+
+    Collects, through the hooks of Api objects, the number of requests,
+    their status codes, latencies, bytes transferred and retries, per
+    method and endpoint.
+    """
+
+    def __init__(self, api=None):
+        """__init__
+
+        :param api: Api object to attach to, if any
+        """
+        self.__lock = threading.Lock()
+        self.stats = {}
+        if api is not None:
+            self.attach(api)
+
+    def attach(self, api):
+        """attach
+
+        Starts recording the requests sent by api.
+
+        :param api: Api object
+        """
+        api.add_hook('post_request', self.record)
+        api.add_hook('retry', self.record_retry)
+
+    def __stats(self, method, url):
+        key = (method, endpoint_of(url))
+        if key not in self.stats:
+            self.stats[key] = {
+                'count': 0,
+                'errors': 0,
+                'retries': 0,
+                'status': {},
+                'seconds': 0.0,
+                'buckets': [0] * len(BUCKETS),
+                'bytes_sent': 0,
+                'bytes_received': 0
+            }
+        return self.stats[key]
+
+    def record(self, method, url, reply, elapsed, error=None):
+        """record
+
+        Hook called after each request.
+
+        :param method: string, http method
+        :param url: string, complete url of the request
+        :param reply: Response object, None if the request failed
+        :param elapsed: float, seconds spent on the request
+        :param error: exception raised by the request, if any
+        """
+        with self.__lock:
+            stats = self.__stats(method, url)
+            stats['count'] += 1
+            stats['seconds'] += elapsed
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    stats['buckets'][i] += 1
+            if reply is None:
+                stats['errors'] += 1
+                return
+            status = str(reply.status_code)
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            if reply.request.body:
+                stats['bytes_sent'] += len(reply.request.body)
+            stats['bytes_received'] += len(reply.content)
+
+    def record_retry(self, method, url, *args):
+        """record_retry
+
+        Hook called before a request is sent again.
+
+        :param method: string, http method
+        :param url: string, complete url of the request
+        """
+        with self.__lock:
+            self.__stats(method, url)['retries'] += 1
+
+    def summary(self):
+        """summary
+
+        Returns a text table of the statistics, the endpoints on which the
+        most time was spent first.
+        """
+        lines = ["{:<7} {:<40} {:>7} {:>7} {:>10} {:>10} {:>12}".format(
+            'method', 'endpoint', 'count', 'errors', 'total(s)', 'mean(ms)',
+            'received'
+        )]
+        with self.__lock:
+            items = sorted(
+                self.stats.items(), key=lambda i: i[1]['seconds'],
+                reverse=True
+            )
+            for (method, endpoint), stats in items:
+                lines.append(
+                    "{:<7} {:<40} {:>7} {:>7} {:>10.3f} {:>10.1f} {:>12}".format(
+                        method, endpoint, stats['count'],
+                        stats['errors'], stats['seconds'],
+                        1000 * stats['seconds'] / stats['count'],
+                        stats['bytes_received']
+                    )
+                )
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """prometheus
+
+        Returns the statistics in the prometheus text exposition format.
+        """
+        lines = []
+        with self.__lock:
+            items = sorted(self.stats.items())
+            lines.append("# HELP netboxapi_requests_total Requests sent to netbox.")
+            lines.append("# TYPE netboxapi_requests_total counter")
+            for (method, endpoint), stats in items:
+                for status, count in sorted(stats['status'].items()):
+                    lines.append(
+                        'netboxapi_requests_total{{method="{}",endpoint="{}",status="{}"}} {}'.format(
+                            method, endpoint, status, count
+                        )
+                    )
+            for name, key, help in (
+                    ('netboxapi_request_errors_total', 'errors',
+                     "Requests that got no reply."),
+                    ('netboxapi_request_retries_total', 'retries',
+                     "Requests sent again."),
+                    ('netboxapi_request_bytes_total', 'bytes_sent',
+                     "Bytes of request bodies."),
+                    ('netboxapi_response_bytes_total', 'bytes_received',
+                     "Bytes of response bodies.")):
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} counter".format(name))
+                for (method, endpoint), stats in items:
+                    lines.append('{}{{method="{}",endpoint="{}"}} {}'.format(
+                        name, method, endpoint, stats[key]
+                    ))
+            name = 'netboxapi_request_duration_seconds'
+            lines.append("# HELP {} Latency of the requests.".format(name))
+            lines.append("# TYPE {} histogram".format(name))
+            for (method, endpoint), stats in items:
+                labels = 'method="{}",endpoint="{}"'.format(method, endpoint)
+                for bound, count in zip(BUCKETS, stats['buckets']):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, bound, count
+                    ))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    name, labels, stats['count']
+                ))
+                lines.append('{}_sum{{{}}} {}'.format(
+                    name, labels, stats['seconds']
+                ))
+                lines.append('{}_count{{{}}} {}'.format(
+                    name, labels, stats['count']
+                ))
+        return "\n".join(lines) + "\n"
+
+    def write_at_exit(self, path=None, format='summary'):
+        """write_at_exit
+
+        Writes the statistics when the process exits.
+
+        :param path: string, file to write to (stderr by default)
+        :param format: string, 'summary' or 'prometheus'
+        """
+        def write():
+            content = self.prometheus() if format == 'prometheus' \
+                else self.summary() + "\n"
+            if path is None:
+                sys.stderr.write(content)
+            else:
+                with open(path, 'w') as fd:
+                    fd.write(content)
+        atexit.register(write)
@@ -0,0 +1,392 @@
+#!/usr/bin/python
+
+"""
+Local mirror of netbox endpoints, for read-heavy tools.
+
+The objects are kept in a sqlite snapshot brought up to date by sync,
+along with indexes on their names, slugs, addresses and references to
+other objects, and on the networks of prefixes for longest-prefix
+matches. Queries are answered locally, the endpoints being synchronized
+again when they are older than the refresh interval.
+"""
+
+import binascii
+import hashlib
+import os
+import socket
+import time
+from cache import default_cache_dir
+from sync import SnapshotStore, sync
+from codec import loads
+
+# Fields indexed with their value
+INDEXED_FIELDS = (
+    'name', 'slug', 'model', 'serial', 'address', 'prefix', 'dns_name',
+    'mac_address', 'assigned_object_type', 'status', 'family'
+)
+
+# Endpoints whose objects are indexed by network
+PREFIX_ENDPOINTS = ('ipam/prefixes', 'ipam/aggregates')
+
+
+def parse_address(address):
+    """parse_address
+
+    Returns a tuple (family, integer value, number of bits) of an ip
+    address, with or without prefix length. Raises ValueError if it is
+    not an address.
+
+    :param address: string, such as '10.0.0.1/24' or '2001:db8::1'
+    """
+    host = address.split('/')[0]
+    family = 6 if ':' in host else 4
+    try:
+        packed = socket.inet_pton(
+            socket.AF_INET6 if family == 6 else socket.AF_INET, host
+        )
+    except (socket.error, UnicodeEncodeError):
+        raise ValueError("Invalid ip address: {}".format(address))
+    return family, int(binascii.hexlify(packed), 16), len(packed) * 8
+
+def _network(value, bits, length):
+    """_network
+
+    Returns the network of length bits containing an address, as a
+    fixed width hexadecimal string.
+
+    :param value: int, address
+    :param bits: int, size of the addresses of the family
+    :param length: int, prefix length
+    """
+    shift = bits - length
+    return "{:0{}x}".format(value >> shift << shift, bits // 4)
+
+def host_address(address):
+    """host_address
+
+    Returns an ip address without prefix length, in its canonical form.
+    Raises ValueError if it is not an address.
+
+    :param address: string, such as '10.0.0.1/24'
+    """
+    family, value, bits = parse_address(address)
+    return unicode(socket.inet_ntop(
+        socket.AF_INET6 if family == 6 else socket.AF_INET,
+        binascii.unhexlify(_network(value, bits, bits))
+    ))
+
+def _index_value(value):
+    """_index_value
+
+    Returns the value stored in the index for a field: the id of nested
+    objects, the value of choices, the string itself otherwise.
+
+    :param value: decoded json value
+    """
+    if isinstance(value, dict):
+        value = value.get('id', value.get('value'))
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    return unicode(value)
+
+
+class MirrorStore(SnapshotStore):
+    """MirrorStore
+
+    Snapshot whose objects are indexed as they are stored: by the fields
+    of INDEXED_FIELDS, by the ids of the objects they refer to (the site of
+    a device is indexed as site), and by network for PREFIX_ENDPOINTS.
+    The addresses of ip addresses are indexed without prefix length.
+    """
+
+    def __init__(self, path):
+        """__init__
+
+        :param path: string, path of the sqlite database (created if it
+        does not exist)
+        """
+        SnapshotStore.__init__(self, path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS fields (
+                endpoint TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value TEXT NOT NULL,
+                id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fields_value
+                ON fields (endpoint, field, value);
+            CREATE INDEX IF NOT EXISTS fields_id ON fields (endpoint, id);
+            CREATE TABLE IF NOT EXISTS networks (
+                endpoint TEXT NOT NULL,
+                family INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                network TEXT NOT NULL,
+                vrf INTEGER,
+                id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS networks_network
+                ON networks (endpoint, family, length, network);
+            CREATE INDEX IF NOT EXISTS networks_id ON networks (endpoint, id);
+        """)
+
+    def __unindex(self, endpoint, idents):
+        for table in ('fields', 'networks'):
+            self.db.executemany(
+                "DELETE FROM {} WHERE endpoint = ? AND id = ?".format(table),
+                ((endpoint, i) for i in idents)
+            )
+
+    def put(self, endpoint, elmt):
+        """put
+
+        Stores or replaces an object, and indexes it.
+
+        :param endpoint: string, 'model/obj'
+        :param elmt: dict, object returned by the api
+        """
+        SnapshotStore.put(self, endpoint, elmt)
+        self.__unindex(endpoint, [elmt['id']])
+        rows = []
+        for field, value in elmt.items():
+            if field not in INDEXED_FIELDS and not (
+                    isinstance(value, dict) and 'id' in value):
+                continue
+            value = _index_value(value)
+            if value is None:
+                continue
+            if field == 'address':
+                try:
+                    value = host_address(value)
+                except ValueError:
+                    pass
+            rows.append((endpoint, field, value, elmt['id']))
+        self.db.executemany("INSERT INTO fields VALUES (?, ?, ?, ?)", rows)
+
+        if endpoint in PREFIX_ENDPOINTS and elmt.get('prefix'):
+            try:
+                family, address, bits = parse_address(elmt['prefix'])
+                length = int(elmt['prefix'].split('/')[1])
+            except (ValueError, IndexError):
+                return
+            vrf = elmt.get('vrf')
+            self.db.execute(
+                "INSERT INTO networks VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, family, length, _network(address, bits, length),
+                 vrf.get('id') if isinstance(vrf, dict) else None,
+                 elmt['id'])
+            )
+
+    def delete(self, endpoint, idents):
+        """delete
+
+        Drops objects and their index entries.
+
+        :param endpoint: string, 'model/obj'
+        :param idents: iterable of ids
+        """
+        idents = list(idents)
+        SnapshotStore.delete(self, endpoint, idents)
+        self.__unindex(endpoint, idents)
+
+    def filter(self, endpoint, limit=None, **criteria):
+        """filter
+
+        Returns the stored objects of an endpoint matching all criteria,
+        by id.
+
+        :param endpoint: string, 'model/obj'
+        :param limit: int, maximum number of objects returned
+        :param **criteria: indexed fields and their values, such as
+        name='sw1', or site=3 for the objects whose site has id 3
+        """
+        query = "SELECT data FROM objects WHERE endpoint = ?"
+        params = [endpoint]
+        for field, value in sorted(criteria.items()):
+            if field == 'id':
+                query += " AND id = ?"
+                params.append(value)
+                continue
+            value = _index_value(value)
+            if field == 'address':
+                value = host_address(value)
+            query += " AND id IN (SELECT id FROM fields WHERE " \
+                "endpoint = ? AND field = ? AND value = ?)"
+            params.extend((endpoint, field, value))
+        query += " ORDER BY id"
+        if limit is not None:
+            query += " LIMIT {:d}".format(limit)
+        return [loads(row[0]) for row in self.db.execute(query, params)]
+
+    def longest_prefix(self, address, vrf=None, endpoint='ipam/prefixes'):
+        """longest_prefix
+
+        Returns the most specific stored prefix containing an address, or
+        None. Each prefix length in use is looked up from the longest one.
+
+        :param address: string, ip address (a prefix length is ignored)
+        :param vrf: int, id of the vrf of the prefix, None for any vrf
+        :param endpoint: string, one of PREFIX_ENDPOINTS
+        """
+        family, value, bits = parse_address(address)
+        lengths = self.db.execute(
+            "SELECT DISTINCT length FROM networks "
+            "WHERE endpoint = ? AND family = ? ORDER BY length DESC",
+            (endpoint, family)
+        ).fetchall()
+        query = "SELECT id FROM networks WHERE endpoint = ? AND family = ? " \
+            "AND length = ? AND network = ?"
+        if vrf is not None:
+            query += " AND vrf = ?"
+        for (length,) in lengths:
+            if length > bits:
+                continue
+            params = [endpoint, family, length, _network(value, bits, length)]
+            if vrf is not None:
+                params.append(vrf)
+            row = self.db.execute(
+                query + " ORDER BY id LIMIT 1", params
+            ).fetchone()
+            if row is not None:
+                return self.get(endpoint, row[0])
+        return None
+
+
+def default_mirror_path(api):
+    """default_mirror_path
+
+    Returns the path of the mirror database of the netbox instance of
+    api, in the cache directory.
+
+    :param api: Api object
+    """
+    return os.path.join(
+        default_cache_dir(),
+        "mirror-{}.sqlite".format(hashlib.sha1(api.url).hexdigest()[:12])
+    )
+
+
+class Mirror(object):
+    """Mirror
+
+    Answers queries on some endpoints from a local MirrorStore. Each
+    query first brings the endpoints up to date if they have not been
+    synchronized for refresh_interval seconds, fetching only the objects
+    changed meanwhile.
+    """
+
+    def __init__(self, api, endpoints, path=None, refresh_interval=300,
+                 page_size=1000, workers=1):
+        """__init__
+
+        :param api: Api object
+        :param endpoints: list of strings, 'model/obj', such as
+        ['dcim/devices', 'ipam/ip-addresses', 'ipam/prefixes']
+        :param path: string, path of the sqlite database (see
+        default_mirror_path)
+        :param refresh_interval: int, seconds after which endpoints are
+        synchronized again, None to only refresh them explicitly
+        :param page_size: int, number of objects requested per page
+        :param workers: int, number of pages fetched at the same time
+        """
+        self.api = api
+        self.endpoints = list(endpoints)
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+        self.workers = workers
+        self.store = MirrorStore(path or default_mirror_path(api))
+        self.__checked = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """close
+
+        Closes the database.
+        """
+        self.store.close()
+
+    def refresh(self, force=False):
+        """refresh
+
+        Synchronizes the endpoints older than the refresh interval, or
+        all of them with force. Returns a dict of the results of sync by
+        endpoint.
+
+        :param force: bool, synchronizes every endpoint
+        """
+        res = {}
+        now = time.time()
+        for endpoint in self.endpoints:
+            state = self.store.state(endpoint)
+            if not force and state is not None and (
+                    self.refresh_interval is None or
+                    now - state[1] < self.refresh_interval):
+                continue
+            model, obj = endpoint.split('/')
+            res[endpoint] = sync(
+                self.api, model, obj, self.store, page_size=self.page_size,
+                workers=self.workers
+            )
+        self.__checked = now
+        return res
+
+    def __check(self, endpoint):
+        if endpoint not in self.endpoints:
+            raise ValueError("{} is not mirrored".format(endpoint))
+        if self.__checked is None or (
+                self.refresh_interval is not None and
+                time.time() - self.__checked >= self.refresh_interval):
+            self.refresh()
+
+    def get(self, endpoint, ident):
+        """get
+
+        Returns an object by id, or None.
+
+        :param endpoint: string, 'model/obj'
+        :param ident: int, id of the object
+        """
+        self.__check(endpoint)
+        return self.store.get(endpoint, ident)
+
+    def filter(self, endpoint, **criteria):
+        """filter
+
+        Returns the objects of an endpoint matching all criteria, by id.
+        See MirrorStore.filter.
+
+        :param endpoint: string, 'model/obj'
+        :param **criteria: indexed fields and their values
+        """
+        self.__check(endpoint)
+        return self.store.filter(endpoint, **criteria)
+
+    def find(self, endpoint, **criteria):
+        """find
+
+        Returns the first object of an endpoint matching all criteria, or
+        None.
+
+        :param endpoint: string, 'model/obj'
+        :param **criteria: indexed fields and their values
+        """
+        self.__check(endpoint)
+        res = self.store.filter(endpoint, limit=1, **criteria)
+        return res[0] if res else None
+
+    def longest_prefix(self, address, vrf=None, endpoint='ipam/prefixes'):
+        """longest_prefix
+
+        Returns the most specific prefix containing an address, or None.
+        See MirrorStore.longest_prefix.
+
+        :param address: string, ip address
+        :param vrf: int, id of the vrf of the prefix, None for any vrf
+        :param endpoint: string, one of PREFIX_ENDPOINTS
+        """
+        self.__check(endpoint)
+        return self.store.longest_prefix(address, vrf, endpoint)
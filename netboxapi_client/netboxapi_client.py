@@ -6,8 +6,166 @@ import logging
 import json
 import sys
 import os
+import random
+import threading
+import time
+from collections import deque
+from timeit import default_timer
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse, parse_qsl
 from urllib import urlencode
+from cache import LRUCache, read_json, write_json_atomic
+from codec import loads, dumps
+from retry import RetryPolicy
+
+# Fields holding the name of objects: model is used by the endpoints whose
+# objects have no name field, such as device types
+NAME_FILTERS = ('name', 'model')
+
+# Aggregate functions of group_by
+AGGREGATES = ('count', 'list', 'distinct', 'sum')
+
+# Seconds to wait for a connection, and for a reply, see Api
+DEFAULT_TIMEOUT = (10, 60)
+
+# Events on which functions can be called, see Api.add_hook
+HOOK_EVENTS = ('pre_request', 'post_request', 'retry')
+
+# Nothing is output unless the application configures logging
+logger = logging.getLogger('netboxapi_client')
+logger.addHandler(logging.NullHandler())
+
+
+def _redact(headers):
+    """_redact
+
+    Returns a copy of headers, as a dict, with the token hidden.
+
+    :param headers: dict of http headers
+    """
+    headers = dict(headers)
+    if 'Authorization' in headers:
+        headers['Authorization'] = "Token ********"
+    return headers
+
+def _truncate(body, limit):
+    """_truncate
+
+    Returns at most limit bytes of body for logging purposes.
+
+    :param body: string or None
+    :param limit: int, maximum number of bytes
+    """
+    if body is None:
+        return ''
+    if len(body) <= limit:
+        return body
+    if isinstance(body, unicode):
+        return u"{}... ({} characters)".format(body[:limit], len(body))
+    return "{}... ({} bytes)".format(body[:limit], len(body))
+
+def _text(value):
+    """_text
+
+    Returns value as unicode, bytes being decoded as utf-8 with the
+    invalid sequences replaced.
+
+    :param value: string, or any object
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+def _endpoint(path):
+    """_endpoint
+
+    Returns the 'app/endpoint' part of path, without ids nor query string.
+
+    :param path: The path provided after https://{self.__url}/api/
+    """
+    parts = [p for p in path.split('?')[0].split('/') if p]
+    return '/'.join(parts[:2])
+
+def _paginated(params):
+    """_paginated
+
+    Returns True if a query string asks for a page of a list, rather than
+    for one object: pages are many, change as objects are added, and are
+    rarely read twice, so they are not kept by the response cache.
+
+    :param params: query string, with or without the leading '?'
+    """
+    query = dict(parse_qsl(params.lstrip('?')))
+    if 'offset' in query or 'ordering' in query:
+        return True
+    return query.get('limit', '1') != '1'
+
+# Headers of the replies kept by the response cache
+CACHED_HEADERS = ('Content-Type', 'API-Version', 'ETag', 'Last-Modified')
+
+def _cache_entry(reply):
+    """_cache_entry
+
+    Returns what the response cache keeps of reply, as a dict.
+
+    :param reply: Response object
+    """
+    return {
+        'url': reply.url,
+        'status': reply.status_code,
+        'headers': dict(
+            (h, reply.headers[h]) for h in CACHED_HEADERS if h in reply.headers
+        ),
+        'content': reply.content.decode('utf-8')
+    }
+
+def _cached_reply(entry):
+    """_cached_reply
+
+    Builds a Response object from an entry of the response cache.
+
+    :param entry: dict returned by _cache_entry
+    """
+    reply = requests.models.Response()
+    reply.url = entry['url']
+    reply.status_code = entry['status']
+    reply.reason = "OK"
+    reply.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    reply.encoding = 'utf-8'
+    reply._content = entry['content'].encode('utf-8')
+    return reply
+
+
+class ApiError(ValueError):
+    """ApiError
+
+    Error reply of the api to a request whose result is needed to go on,
+    such as a page of a list. The message holds the detail given by
+    netbox. It is unicode, and str() gives it encoded as utf-8.
+    """
+
+    def __init__(self, reply):
+        """__init__
+
+        :param reply: Response object, with an error status
+        """
+        self.status_code = reply.status_code
+        try:
+            self.detail = loads(reply.content)
+            if isinstance(self.detail, dict) and 'detail' in self.detail:
+                self.detail = self.detail['detail']
+        except ValueError:
+            self.detail = _truncate(reply.text, 200)
+        ValueError.__init__(self, u"{} {} on {}: {}".format(
+            reply.status_code, _text(reply.reason), _text(reply.url),
+            _text(self.detail)
+        ))
+
+    def __unicode__(self):
+        return self.args[0]
+
+    def __str__(self):
+        return self.args[0].encode('utf-8')
 
 
 class Api(object):
@@ -24,10 +182,59 @@ class Api(object):
         Initializes __url __headers and __token variables,
         which are used to build requests to the api.
 
+        The http session shared by all verbs keeps connections open
+        between requests. It can be tuned with the following keyword
+        arguments:
+
+        - pool_connections: number of hosts for which a connection pool
+          is kept (default 10)
+        - pool_maxsize: maximum number of connections kept open per host
+          (default 10)
+        - pool_block: if True, a request waits for a free connection
+          instead of opening one beyond pool_maxsize (default False)
+        - keep_alive: if False, connections are closed after each request
+          (default True)
+
+        Ids found by get_id_by_name are remembered, and forgotten when an
+        object of the same endpoint is changed through this object:
+
+        - name_cache_size: maximum number of names remembered, 0 disables
+          the cache (default 1024)
+        - name_cache_ttl: seconds during which an id is trusted
+          (default 300)
+        - name_cache_file: path of a json file the names are loaded from,
+          and saved to by close() (default None)
+
+        Requests are logged at DEBUG level on the 'netboxapi_client'
+        logger, with the token hidden. Bodies are only read for logging
+        when that level is enabled:
+
+        - log_body_limit: number of bytes of the bodies logged, 0 to log
+          no body (default 1024)
+        - log_sample_rate: fraction of the requests whose bodies are
+          logged (default 1.0)
+
+        Failed requests are sent again when it is safe to do so:
+
+        - retry: a RetryPolicy object, or the maximum number of retries
+          for the default policy (default RetryPolicy())
+        - max_in_flight: maximum number of requests sent at the same time
+          by all the threads using this object (default None, no limit)
+        - timeout: seconds to wait for a connection and for a reply, as
+          a number or a (connect, read) tuple, None to wait forever
+          (default DEFAULT_TIMEOUT)
+
+        Replies of get requests can be kept by a ResponseCache, given with
+        the response_cache keyword argument (default None, no cache), the
+        pages of lists excepted. The endpoints written to through this
+        object are dropped from it.
+
+        Functions can be called around each request (see add_hook) with
+        the hooks keyword argument, a dict of lists of functions by event.
+
         :param *args:
         :param **kwargs: should contain at least 'url' and 'token'
         """
-        logging.basicConfig(filename='netboxapi.log', level=logging.DEBUG)
         self.__url = kwargs.get('url')
         self.__last_reply = None
         self.__headers = {}
@@ -35,28 +242,257 @@ class Api(object):
         if 'token' in kwargs:
             self.__token = kwargs.get('token')
             self.__headers['Authorization'] = "Token {}".format(self.__token)
-            self.__headers['Accept'] = "application/json; indent=4"
+            self.__headers['Accept'] = "application/json"
             self.__headers['Content-Type'] = "application/json"
-        logging.info("Header: {}".format(self.__headers))
+        if not kwargs.get('keep_alive', True):
+            self.__headers['Connection'] = "close"
+        self.__log_body_limit = kwargs.get('log_body_limit', 1024)
+        self.__log_sample_rate = kwargs.get('log_sample_rate', 1.0)
+        logger.debug("Header: %s", _redact(self.__headers))
+        retry = kwargs.get('retry', RetryPolicy())
+        if not isinstance(retry, RetryPolicy):
+            retry = RetryPolicy(retries=retry)
+        self.__retry = retry
+        self.__timeout = kwargs.get('timeout', DEFAULT_TIMEOUT)
+        if isinstance(self.__timeout, list):
+            self.__timeout = tuple(self.__timeout)
+        self.__in_flight = None
+        if kwargs.get('max_in_flight'):
+            self.__in_flight = threading.BoundedSemaphore(
+                kwargs['max_in_flight']
+            )
+        self.__hooks = dict((event, []) for event in HOOK_EVENTS)
+        for event, funcs in kwargs.get('hooks', {}).items():
+            for func in funcs:
+                self.add_hook(event, func)
+        self.__session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=kwargs.get('pool_connections', 10),
+            pool_maxsize=kwargs.get('pool_maxsize', 10),
+            pool_block=kwargs.get('pool_block', False)
+        )
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+        self.__names = LRUCache(
+            maxsize=kwargs.get('name_cache_size', 1024),
+            ttl=kwargs.get('name_cache_ttl', 300)
+        )
+        self.__names_file = kwargs.get('name_cache_file')
+        self.__responses = kwargs.get('response_cache')
+        self.__revalidating = set()
+        self.__revalidating_lock = threading.Lock()
+        if self.__names_file:
+            content = read_json(self.__names_file) or {}
+            self.__names.load(content.get(self.__url, []))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """close
+
+        Closes the connections kept open by the http session, and saves
+        the name cache if a file has been given for it.
+        """
+        self.__session.close()
+        if self.__names_file:
+            content = read_json(self.__names_file) or {}
+            content[self.__url] = self.__names.dump()
+            try:
+                write_json_atomic(self.__names_file, content)
+            except (IOError, OSError):
+                logger.warning(
+                    "Could not save name cache to %s", self.__names_file
+                )
+
+    def forget_names(self, path=""):
+        """forget_names
+
+        Drops the cached ids of the objects of an endpoint. If path
+        ends with an id, only the names pointing to that object are
+        dropped.
+
+        :param path: The path to provide after https://{self.__url}/api/
+        """
+        parts = [p for p in path.split('/') if p]
+        ident = None
+        if parts and parts[-1].isdigit():
+            ident = int(parts.pop())
+        endpoint = '/'.join(parts)
+        self.__names.remove_if(
+            lambda k, v: k[0] == endpoint and ident in (None, v)
+        )
+
+    def __forget(self, path="", names=True):
+        """__forget
+
+        Drops what is known of an endpoint about to be written to.
+
+        :param path: The path to provide after https://{self.__url}/api/
+        :param names: bool, if False the name cache is kept, as creating
+        an object does not change the ids of the others
+        """
+        if names:
+            self.forget_names(path)
+        if self.__responses is not None:
+            self.__responses.invalidate(_endpoint(path))
+
+    def add_hook(self, event, func):
+        """add_hook
+
+        Registers func to be called on event:
+
+        - pre_request: before each request, as func(method, url, kwargs),
+          kwargs being the arguments given to requests
+        - post_request: after each request, as func(method, url, reply,
+          elapsed, error), reply being None and error the exception
+          raised if the request failed, elapsed in seconds
+        - retry: before a request is sent again, as func(method, url,
+          attempt, delay)
+
+        :param event: string, one of HOOK_EVENTS
+        :param func: function
+        """
+        if event not in self.__hooks:
+            raise ValueError("Unknown hook event: {}".format(event))
+        self.__hooks[event].append(func)
+
+    def remove_hook(self, event, func):
+        """remove_hook
+
+        Unregisters a function registered by add_hook.
+
+        :param event: string, one of HOOK_EVENTS
+        :param func: function
+        """
+        self.__hooks[event].remove(func)
+
+    def __run_hooks(self, event, *args):
+        for func in self.__hooks[event]:
+            func(*args)
+
+    @property
+    def url(self):
+        """url
+
+        Url of the netbox instance this object talks to.
+        """
+        return self.__url
+
+    @property
+    def last_reply(self):
+        """last_reply
+
+        Response object of the last request sent, or None.
+        """
+        return self.__last_reply
+
+    def __log_reply(self, reply):
+        """__log_reply
+
+        Records reply via logging module, if DEBUG level is enabled for
+        the 'netboxapi_client' logger. Bodies are truncated to
+        log_body_limit bytes and only logged for a log_sample_rate
+        fraction of the requests.
+
+        :param reply: Response object
+        """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug(
+            "%s %s Status code: %s Reason: %s Elapsed: %s",
+            reply.request.method, reply.request.url, reply.status_code,
+            reply.reason, reply.elapsed
+        )
+        if self.__log_body_limit <= 0 or \
+                random.random() >= self.__log_sample_rate:
+            return
+        logger.debug(
+            "Request: %s %s\n Response: %s",
+            _redact(reply.request.headers),
+            _truncate(reply.request.body, self.__log_body_limit),
+            _truncate(reply.content, self.__log_body_limit)
+        )
+
+    def __send(self, method, url, **kwargs):
+        """__send
 
-    def __log_last_request_and_reply(self):
-        """__log_last_request_and_reply
+        Sends one http request through the session shared by all verbs,
+        and returns the reply as a Response object.
 
-        Records __last_reply content via logging module.
-        (should appear in the log file though)
+        :param method: string, http method
+        :param url: string, complete url of the request
+        :param **kwargs: passed to requests.Session.request
         """
-        logging.info(
-            "POST Status code: {0} Reason: {1} Request: {2} {3}\n \
-            Response: {4}".format(
-            self.__last_reply.status_code,
-            self.__last_reply.reason,
-            self.__last_reply.request.headers,
-            self.__last_reply.request.body,
-            self.__last_reply.text.encode('utf-8')
+        self.__run_hooks('pre_request', method, url, kwargs)
+        start = default_timer()
+        if self.__in_flight is not None:
+            self.__in_flight.acquire()
+        try:
+            headers = self.__headers
+            if 'headers' in kwargs:
+                headers = dict(headers, **kwargs.pop('headers'))
+            kwargs.setdefault('timeout', self.__timeout)
+            reply = self.__session.request(
+                method, url, headers=headers, verify=False, **kwargs
+            )
+        except Exception as e:
+            self.__run_hooks(
+                'post_request', method, url, None, default_timer() - start, e
             )
+            raise
+        finally:
+            if self.__in_flight is not None:
+                self.__in_flight.release()
+        self.__run_hooks(
+            'post_request', method, url, reply, default_timer() - start, None
         )
+        return reply
+
+    def __request(self, method, url, **kwargs):
+        """__request
+
+        Sends an http request, and sends it again as long as the retry
+        policy allows it. Records the reply and returns it as a Response
+        object.
 
-    def get(self, path="", params=""):
+        :param method: string, http method
+        :param url: string, complete url of the request
+        :param **kwargs: passed to requests.Session.request
+        """
+        attempt = 0
+        while True:
+            reply = None
+            error = None
+            try:
+                # The reply is kept in a local variable: other threads
+                # may send requests through the same object meanwhile
+                reply = self.__send(method, url, **kwargs)
+            except requests.exceptions.SSLError:
+                raise
+            except requests.exceptions.RequestException as e:
+                error = e
+            if attempt >= self.__retry.retries or \
+                    not self.__retry.is_retryable(method, reply, error):
+                break
+            delay = self.__retry.delay(attempt, reply)
+            attempt += 1
+            logger.warning(
+                "%s %s failed (%s), retry %s in %.1fs", method, url,
+                error or reply.status_code, attempt, delay
+            )
+            self.__run_hooks('retry', method, url, attempt, delay)
+            time.sleep(delay)
+        if error is not None:
+            raise error
+        self.__last_reply = reply
+        self.__log_reply(reply)
+        return reply
+
+    def get(self, path="", params="", fields=None, brief=False):
         """get
 
         Triggers a get http request to the http api endpoint. Returns the
@@ -64,24 +500,169 @@ class Api(object):
 
         :param path: The path to provide after https://{self.__url}/api/
         :param params: '?param1=foo&param2=bar' stuff, as a string.
+        :param fields: list of the fields to ask netbox for (dotted paths
+        are reduced to their first component), ignored by netbox < 4.0
+        :param brief: bool, asks netbox for the minimal representation of
+        the objects
         """
+        extra = {}
+        if brief:
+            extra['brief'] = 1
+        if fields:
+            extra['fields'] = ','.join(_top_fields(fields))
+        if extra:
+            params = "{}{}{}".format(
+                params or "?", "&" if len(params) > 1 else "", urlencode(extra)
+            )
         try:
             if len(params) > 0:
-                path = "{}/{}".format(path, params)
-            self.__last_reply = requests.get(
-                "{0}/api/{1}".format(self.__url, path),
-                headers=self.__headers, verify=False
-            )
-            self.__log_last_request_and_reply()
+                path = "{}/{}".format(path.rstrip('/'), params)
+            url = "{0}/api/{1}".format(self.__url, path)
+            if self.__responses is not None and not _paginated(params):
+                return self.__cached_get(url, _endpoint(path))
+            return self.__request("GET", url)
         except requests.exceptions.SSLError:
-            logging.warning("Certificate verify failed.")
-        return self.__last_reply
+            logger.warning("Certificate verify failed.")
+            raise
+
+    def __cached_get(self, url, group):
+        """__cached_get
+
+        Returns the reply to a get request from the response cache when it
+        is fresh enough, revalidates it otherwise.
+
+        :param url: string, complete url of the request
+        :param group: string, endpoint of the request
+        """
+        entry = self.__responses.get(url, group)
+        if entry is not None:
+            age = self.__responses.age(entry)
+            if age > self.__responses.ttl and \
+                    age <= self.__responses.ttl + \
+                    self.__responses.stale_while_revalidate:
+                self.__revalidate_later(url, group, entry)
+            elif age > self.__responses.ttl:
+                return self.__revalidate(url, group, entry)
+            reply = _cached_reply(entry)
+            self.__last_reply = reply
+            return reply
+        return self.__revalidate(url, group, None)
+
+    def __revalidate(self, url, group, entry):
+        """__revalidate
+
+        Sends a get request, conditional if entry has validators, and
+        updates the response cache with its reply.
+
+        :param url: string, complete url of the request
+        :param group: string, endpoint of the request
+        :param entry: dict, cached reply or None
+        """
+        generation = self.__responses.generation(group)
+        headers = {}
+        if entry is not None:
+            if 'ETag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        reply = self.__request("GET", url, headers=headers)
+        if reply.status_code == 304 and entry is not None:
+            self.__responses.set(url, group, entry, generation)
+            reply = _cached_reply(entry)
+            self.__last_reply = reply
+        elif reply.status_code == 200:
+            self.__responses.set(url, group, _cache_entry(reply), generation)
+        return reply
+
+    def __revalidate_later(self, url, group, entry):
+        """__revalidate_later
+
+        Revalidates a cached reply from a background thread, unless that
+        is already being done.
+
+        :param url: string, complete url of the request
+        :param group: string, endpoint of the request
+        :param entry: dict, cached reply
+        """
+        with self.__revalidating_lock:
+            if url in self.__revalidating:
+                return
+            self.__revalidating.add(url)
+
+        def run():
+            try:
+                self.__revalidate(url, group, entry)
+            except requests.exceptions.RequestException as e:
+                logger.warning("Could not revalidate %s: %s", url, e)
+            finally:
+                with self.__revalidating_lock:
+                    self.__revalidating.discard(url)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
 
     def get_id_by_name(self, path="", name=""):
         """get_id_by_name
 
         Returns the numerical id of an object based on its name.
 
+        The name is first looked up with the name filter, or the model
+        filter for the endpoints whose objects have no name, asking for a
+        single object. Netbox ignores the filters an endpoint does not
+        support: if it answers with an object that has the field but does
+        not match, the endpoint is walked page by page instead. Ids found
+        are kept in the name cache.
+
+        :param path: The path to provide after https://{self.__url}/api/
+        :param name: The name of the object.
+        """
+        key = ('/'.join(p for p in path.split('/') if p), name)
+        ident = self.__names.get(key)
+        if ident is None:
+            ident = self.__find_id_by_name(path, name)
+            if ident is not None:
+                self.__names.set(key, ident)
+        return ident
+
+    def __find_id_by_name(self, path="", name=""):
+        """__find_id_by_name
+
+        Looks up the numerical id of an object with the name filter of
+        the endpoint, or its model filter if its objects have no name.
+        Slugs are never taken for names.
+
+        :param path: The path to provide after https://{self.__url}/api/
+        :param name: The name of the object.
+        """
+        if isinstance(name, unicode):
+            value = name.encode('utf-8')
+        else:
+            value = name
+        for key in NAME_FILTERS:
+            reply = self.get(
+                path, "?{}".format(urlencode({key: value, 'limit': 1}))
+            )
+            try:
+                results = loads(reply.content)['results']
+            except (ValueError, KeyError):
+                return self.__scan_id_by_name(path, name)
+            if len(results) == 0:
+                return None
+            if key not in results[0]:
+                # The objects of the endpoint have no such field
+                continue
+            if results[0][key] == name:
+                return results[0]['id']
+            # The filter has been ignored
+            return self.__scan_id_by_name(path, name)
+        return None
+
+    def __scan_id_by_name(self, path="", name=""):
+        """__scan_id_by_name
+
+        Returns the numerical id of an object based on its name, by reading
+        every object of the endpoint.
+
         :param path: The path to provide after https://{self.__url}/api/
         :param name: The name of the object.
         """
@@ -91,9 +672,9 @@ class Api(object):
         next = True
         while next:
             page += 1
-            self.get(path, "?{}".format(params))
+            reply = self.get(path, "?{}".format(params))
             try:
-                elements = self.__last_reply.json()
+                elements = loads(reply.content)
                 for e in elements['results']:
                     if 'name' in e:
                         if e['name'] == name:
@@ -122,8 +703,7 @@ class Api(object):
 
         :param path: The path to provide after https://{self.__url}/api/
         """
-        self.get(path, params="?limit=0")
-        return self.__last_reply
+        return self.get(path, params="?limit=0")
 
     def post(self, path="", payload={}):
         """post
@@ -133,34 +713,38 @@ class Api(object):
         :param path: The path to provide after https://{self.__url}/api/
         :param payload: The content of the post request.
         """
+        self.__forget(path, names=False)
         try:
-            self.__last_reply = requests.post(
-                "{0}/api/{1}".format(self.__url, path), headers=self.__headers,
-                data=json.dumps(payload), verify=False
+            return self.__request(
+                "POST", "{0}/api/{1}".format(self.__url, path),
+                data=dumps(payload)
             )
-            self.__log_last_request_and_reply()
-            return self.__last_reply
         except requests.exceptions.SSLError:
-            logging.warning("Certificate verify failed.")
+            logger.warning("Certificate verify failed.")
+            raise
 
-    def delete(self, path=""):
+    def delete(self, path="", payload=None):
         """delete
 
         Sends an http rest delete request.
 
         :param path: The path to provide after https://{self.__url}/api/
+        :param payload: The payload of the delete request, if any (a list
+        of {'id': ...} dicts to delete several objects of an endpoint).
         """
+        self.__forget(path)
+        kwargs = {}
+        if payload is not None:
+            kwargs['data'] = dumps(payload)
         try:
-            self.__last_reply = requests.delete(
-                "{0}/api/{1}".format(self.__url, path),
-                headers=self.__headers, verify=False
+            return self.__request(
+                "DELETE", "{0}/api/{1}".format(self.__url, path), **kwargs
             )
-            self.__log_last_request_and_reply()
-            return self.__last_reply
         except requests.exceptions.SSLError:
-            logging.warning("Certificate verify failed.")
+            logger.warning("Certificate verify failed.")
+            raise
         except ValueError:
-            logging.warning("ValueError")
+            logger.warning("ValueError")
 
     def put(self, path="", payload={}):
         """put
@@ -170,16 +754,15 @@ class Api(object):
         :param path: The path to provide after https://{self.__url}/api/
         :param payload: The payload of the put request.
         """
+        self.__forget(path)
         try:
-            self.__last_reply = requests.put(
-                "{0}/api/{1}/".format(self.__url, path),
-                headers=self.__headers, data=json.dumps(payload),
-                verify=False
+            return self.__request(
+                "PUT", "{0}/api/{1}/".format(self.__url, path),
+                data=dumps(payload)
             )
-            self.__log_last_request_and_reply()
-            return self.__last_reply
         except requests.exceptions.SSLError:
-            logging.warning("Certificate verify failed.")
+            logger.warning("Certificate verify failed.")
+            raise
 
     def patch(self, path="", payload={}):
         """patch
@@ -187,32 +770,200 @@ class Api(object):
         :param path:
         :param payload:
         """
+        self.__forget(path)
         try:
-            self.__last_reply = requests.patch(
-				"{0}/api/{1}/".format(self.__url, path),
-				headers=self.__headers, data=json.dumps(payload),
-				verify=False
-			)
-            return self.__last_reply
+            return self.__request(
+                "PATCH", "{0}/api/{1}/".format(self.__url, path),
+                data=dumps(payload)
+            )
         except requests.exceptions.SSLError:
-            logging.warning("Certificate verify failed.")
+            logger.warning("Certificate verify failed.")
+            raise
 
 
 # == Main CLI
 #
 # === Helpers
 #
-def print_json(obj):
-    print( json.dumps(
-        obj,
-        sort_keys=True,
-        indent=4, separators=(',', ': ')
-    ))
+def print_json(obj, output='json'):
+    """print_json
+
+    Displays obj as json.
+
+    :param obj: data to display
+    :param output: string, 'json' for an indented document with sorted
+    keys, 'json-compact' or 'ndjson' for a single line
+    """
+    print(dumps(obj, pretty=(output == 'json')))
+
+def print_ndjson(obj):
+    print(dumps(obj))
+
+def read_objects(path):
+    """read_objects
+
+    Yields the objects of a json file, which can either contain a list of
+    objects or one object per line. The latter is read line by line.
+
+    :param path: string, path of the file, or '-' for stdin
+    """
+    fd = sys.stdin if path == '-' else open(path)
+    try:
+        first = ''
+        while not first.strip():
+            first = fd.readline()
+            if not first:
+                return
+        if first.lstrip().startswith('['):
+            for elmt in loads(first + fd.read()):
+                yield elmt
+            return
+        yield loads(first)
+        for line in fd:
+            if line.strip():
+                yield loads(line)
+    finally:
+        if fd is not sys.stdin:
+            fd.close()
+
+def _chunks(iterable, size):
+    """_chunks
+
+    Yields lists of at most size elements of iterable.
+
+    :param iterable: elements to group
+    :param size: int, maximum number of elements per list
+    """
+    chunk = []
+    for elmt in iterable:
+        chunk.append(elmt)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _urlencode(params):
+    """_urlencode
+
+    Returns params as a query string. List values give the parameter
+    several times, and unicode values are sent as utf-8.
+
+    :param params: dict
+    """
+    def encode(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    items = []
+    for key, value in params.items():
+        if isinstance(value, (list, tuple, set)):
+            items.extend((key, encode(v)) for v in value)
+        else:
+            items.append((key, encode(value)))
+    return urlencode(items)
+
+def _field_list(fields):
+    """_field_list
+
+    Returns fields as a list of dotted paths. A string is split on commas.
+
+    :param fields: list of strings, or comma separated string, or None
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, basestring):
+        return [f.strip() for f in fields.split(',') if f.strip()]
+    return list(fields)
+
+def _top_fields(fields):
+    """_top_fields
+
+    Returns the first component of each dotted path of fields, without
+    duplicates, in order.
+
+    :param fields: list of dotted paths
+    """
+    top = []
+    for field in _field_list(fields):
+        field = field.split('.')[0]
+        if field not in top:
+            top.append(field)
+    return top
+
+def project(elmt, fields):
+    """project
+
+    Returns a copy of elmt restricted to fields. Each field is a dotted
+    path, 'tenant.name' keeping only the name of the tenant. Missing
+    fields are left out, and null nested objects are kept as None.
+
+    :param elmt: dict, object returned by the api
+    :param fields: list of dotted paths, or comma separated string
+    """
+    res = {}
+    for field in _field_list(fields):
+        src = elmt
+        dst = res
+        keys = field.split('.')
+        for i, key in enumerate(keys):
+            if not isinstance(src, dict) or key not in src:
+                break
+            src = src[key]
+            if i == len(keys) - 1 or src is None:
+                dst[key] = src
+                break
+            dst = dst.setdefault(key, {})
+    return res
+
+def resolve(elmt, path, default=None):
+    """resolve
+
+    Returns the value of a dotted path in elmt, 'tenant.name' giving the
+    name of the tenant, or default if it is missing or null.
+
+    :param elmt: dict (or record), object returned by the api
+    :param path: string, dotted path
+    :param default: returned for missing values
+    """
+    for key in path.split('.'):
+        if elmt is None:
+            return default
+        try:
+            elmt = elmt[key]
+        except (KeyError, TypeError):
+            return default
+    return default if elmt is None else elmt
+
+def _ordered_map(func, iterable, workers):
+    """_ordered_map
+
+    Calls func on each element of iterable from a pool of threads, and
+    yields the results in the order of iterable. At most 2 * workers calls
+    are pending at a time, so that results do not pile up in memory when
+    the consumer is slower than the workers.
+
+    :param func: function taking one argument
+    :param iterable: arguments to call func with
+    :param workers: int, number of threads
+    """
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for elmt in iterable:
+            pending.append(pool.apply_async(func, (elmt,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
 
 
 # === Commands
 #
-def show(api, model, obj, ident=None, name=None):
+def show(api, model, obj, ident=None, name=None, output='json', **kwargs):
     """show
 
     Calls api object and its get function (and optionally get_id_by_name).
@@ -223,14 +974,17 @@ def show(api, model, obj, ident=None, name=None):
     :param obj: string, tells which object to use
     :param ident: int, numerical identifier of the object
     :param name: string, name of the object
+    :param output: string, display format (see print_json)
+    :param **kwargs: passed to get
     """
-    res = get(api, model, obj, ident, name)
+    res = get(api, model, obj, ident, name, **kwargs)
 
     # Display
-    print_json(res)
+    print_json(res, output)
     return res
 
-def get(api, model, obj, ident=None, name=None):
+def get(api, model, obj, ident=None, name=None, fields=None, brief=False,
+        registry=None, **kwargs):
     """get
 
     Calls api object and its get function (and optionally get_id_by_name).
@@ -241,32 +995,56 @@ def get(api, model, obj, ident=None, name=None):
     :param obj: string, tells which object to use
     :param ident: int, numerical identifier of the object
     :param name: string, name of the object
+    :param fields: list of dotted paths (or comma separated string) of the
+    fields to return, asked to the server and applied on the reply
+    :param brief: bool, asks for the minimal representation of the object
+    :param registry: records.Registry object, to get the object as a
+    record instead of a dict
+    :param **kwargs:
     """
     if ident is None and name is not None:
         ident = api.get_id_by_name(
             "{}/{}".format(model, obj), name
         )
-    return api.get(
-            "{}/{}/{}".format(
-                model, obj, ident
-            )
-        ).json()
+    reply = api.get(
+        "{}/{}/{}".format(
+            model, obj, ident
+        ), fields=fields, brief=brief
+    )
+    res = loads(reply.content)
+    # Errors are returned as they are
+    if reply.status_code >= 400:
+        return res
+    if fields:
+        res = project(res, fields)
+    if registry is not None:
+        res = registry.record("{}/{}".format(model, obj), res)
+    return res
 
-def enum(api, model, obj, **kwargs):
+def enum(api, model, obj, output='ndjson', **kwargs):
     """enum
 
-    Displays and returns all instances of an object, as json data.
+    Displays all instances of an object, one json document per line by
+    default, while they are fetched page by page. Returns the number of
+    objects displayed. An error reply of the api is displayed on stderr.
 
     :param api: Api object
     :param model: string, tells which data model to use
     :param obj: string tells which object to use
-    :param **kwargs:
+    :param output: string, display format of each object (see print_json)
+    :param **kwargs: passed to iter_list
     """
-    res = get_list(api, model, obj)
-    print_json(res)
-    return res
+    count = 0
+    try:
+        for elmt in iter_list(api, model, obj, **kwargs):
+            print_json(elmt, output)
+            count += 1
+    except ApiError as e:
+        sys.stderr.write("{}\n".format(e))
+    return count
 
-def get_list(api, model, obj, **kwargs):
+def get_list(api, model, obj, fields=None, brief=False, registry=None,
+             **kwargs):
     """get_list
 
     Returns all instances of an object, as json data.
@@ -274,35 +1052,426 @@ def get_list(api, model, obj, **kwargs):
     :param api: Api object
     :param model: string, tells which data model to use
     :param obj: string tells which object to use
+    :param fields: list of dotted paths (or comma separated string) of the
+    fields to return, asked to the server and applied on the reply
+    :param brief: bool, asks for the minimal representation of objects
+    :param registry: records.Registry object, to get the objects as
+    records instead of dicts
     :param **kwargs:
     """
     if model and obj:
-        res  = api.get("{}/{}/".format(model, obj)).json()
+        res  = loads(api.get(
+            "{}/{}/".format(model, obj), fields=fields, brief=brief
+        ).content)
+        if fields and 'results' in res:
+            res['results'] = [project(e, fields) for e in res['results']]
+        if registry is not None and 'results' in res:
+            res['results'] = [
+                registry.record("{}/{}".format(model, obj), e)
+                for e in res['results']
+            ]
+        return res
+
+def iter_list(api, model, obj, page_size=50, workers=1, fields=None,
+              brief=False, filters=None, registry=None, **kwargs):
+    """iter_list
+
+    Yields all instances of an object, one at a time, following the
+    pagination of the api. Only the pages being read are kept in memory.
+
+    With workers > 1, the number of pages is computed from the count of
+    the first reply and the next pages are requested concurrently, at most
+    2 * workers at a time, while objects are still yielded in order. The
+    pool_maxsize of the Api object should be at least workers.
+
+    Raises ApiError if netbox answers a page with an error.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param page_size: int, number of objects requested per page (netbox
+    may cap it with its MAX_PAGE_SIZE setting)
+    :param workers: int, number of pages fetched at the same time
+    :param fields: list of dotted paths (or comma separated string) of the
+    fields to return, asked to the server and applied on the replies
+    :param brief: bool, asks for the minimal representation of objects
+    :param filters: dict of netbox filters, such as {'site': 'par1'} or
+    {'last_updated__gte': '2018-01-01'}, a list value giving the same
+    filter several times
+    :param registry: records.Registry object, to get the objects as
+    records instead of dicts
+    :param **kwargs:
+    """
+    path = "{}/{}".format(model, obj)
+    params = dict(filters or {})
+    params.update({'limit': page_size, 'offset': 0})
+    if brief:
+        params['brief'] = 1
+    if fields:
+        params['fields'] = ','.join(_top_fields(fields))
+
+    def fetch(params):
+        reply = api.get(path, "?{}".format(params))
+        if reply.status_code >= 400:
+            raise ApiError(reply)
+        elements = loads(reply.content)
+        if fields:
+            elements['results'] = [
+                project(e, fields) for e in elements['results']
+            ]
+        if registry is not None:
+            elements['results'] = [
+                registry.record(path, e) for e in elements['results']
+            ]
+        return elements
+
+    elements = fetch(_urlencode(params))
+    if workers > 1 and elements['next'] is not None:
+        # The server may have capped the page size
+        limit = len(elements['results'])
+        for e in elements['results']:
+            yield e
+        del elements['results']
+
+        def fetch_page(offset):
+            page_params = dict(params, limit=limit, offset=offset)
+            return fetch(_urlencode(page_params))['results']
+
+        offsets = xrange(limit, elements['count'], limit)
+        for page in _ordered_map(fetch_page, offsets, workers):
+            for e in page:
+                yield e
+        return
+
+    while True:
+        for e in elements['results']:
+            yield e
+
+        if elements['next'] is None:
+            break
+        elements = fetch(urlparse(elements['next']).query)
+
+def _unique(keys):
+    """_unique
+
+    Returns the elements of keys without duplicates, in order.
+
+    :param keys: iterable, or None
+    """
+    seen = set()
+    res = []
+    for key in keys or ():
+        if key not in seen:
+            seen.add(key)
+            res.append(key)
+    return res
+
+def iter_many(api, model, obj, idents=None, names=None, chunk_size=100,
+              workers=1, fields=None, brief=False, registry=None,
+              lookup_names=True, **kwargs):
+    """iter_many
+
+    Yields (key, object) tuples for the given ids, then for the given
+    names, in order and without duplicates, except for the objects
+    sharing a name, which are all yielded. Keys are looked up by chunks:
+    one request with the id (or name) filter given several times returns
+    the objects of a whole chunk. Names the filter does not find (on
+    endpoints using model for instance) are then looked up one at a
+    time with get_id_by_name, unless lookup_names is False. Keys of
+    objects that do not exist are left out. Raises ApiError if netbox
+    answers a request with an error.
+
+    With workers > 1, chunks are fetched concurrently, at most
+    2 * workers at a time. The pool_maxsize of the Api object should be at
+    least workers.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string, tells which object to use
+    :param idents: list of numerical identifiers
+    :param names: list of names
+    :param chunk_size: int, number of keys per request
+    :param workers: int, number of chunks fetched at the same time
+    :param fields: list of dotted paths (or comma separated string) of the
+    fields to return, asked to the server and applied on the replies
+    :param brief: bool, asks for the minimal representation of objects
+    :param registry: records.Registry object, to get the objects as
+    records instead of dicts
+    :param lookup_names: bool, looks up the names the chunk filter does
+    not find one at a time (3 requests each for the missing ones)
+    :param **kwargs:
+    """
+    path = "{}/{}".format(model, obj)
+    params = {}
+    if brief:
+        params['brief'] = 1
+    if fields:
+        params['fields'] = ','.join(_top_fields(
+            _field_list(fields) + ['id', 'name']
+        ))
+
+    def convert(elmt):
+        if fields:
+            elmt = project(elmt, fields)
+        if registry is not None:
+            elmt = registry.record(path, elmt)
+        return elmt
+
+    def fetch(chunk):
+        key, values = chunk
+        found = {}
+        query = _urlencode(dict(params, limit=len(values), **{key: values}))
+        while query is not None:
+            reply = api.get(path, "?{}".format(query))
+            if reply.status_code >= 400:
+                raise ApiError(reply)
+            elements = loads(reply.content)
+            for e in elements['results']:
+                found.setdefault(e.get(key), []).append(e)
+            # The server may have capped the page size
+            query = elements['next'] and urlparse(elements['next']).query
+        res = []
+        for value in values:
+            elements = found.get(value, [])
+            if not elements and key == 'name' and lookup_names:
+                ident = api.get_id_by_name(path, value)
+                if ident is not None:
+                    # Same fields as the chunks, id included
+                    reply = api.get(
+                        "{}/{}".format(path, ident),
+                        "?{}".format(_urlencode(params)) if params else ""
+                    )
+                    if reply.status_code < 400:
+                        elements = [loads(reply.content)]
+                    elif reply.status_code != 404:
+                        # A 404 tells it has been deleted meanwhile
+                        raise ApiError(reply)
+            for elmt in elements:
+                if 'id' in elmt:
+                    res.append((value, convert(elmt)))
         return res
 
+    chunks = [('id', c) for c in _chunks(
+        _unique(int(i) for i in idents or ()), chunk_size
+    )] + [('name', c) for c in _chunks(_unique(names), chunk_size)]
+    if workers > 1:
+        results = _ordered_map(fetch, chunks, workers)
+    else:
+        results = (fetch(c) for c in chunks)
+    for res in results:
+        for item in res:
+            yield item
+
+def get_many(api, model, obj, idents=None, names=None, **kwargs):
+    """get_many
+
+    Returns the objects of the given ids and names, as a dict mapping
+    each id or name found to its object (the last one found for names
+    shared by several objects). See iter_many.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string, tells which object to use
+    :param idents: list of numerical identifiers
+    :param names: list of names
+    :param **kwargs: passed to iter_many
+    """
+    return dict(iter_many(api, model, obj, idents, names, **kwargs))
+
+def _group_key(value):
+    """_group_key
+
+    Returns the key of the group of a value: nested objects are grouped
+    by their name (or slug, or id), choices such as status by their
+    value, lists by their items.
+
+    :param value: value of the grouping field
+    """
+    if isinstance(value, dict):
+        for key in ('name', 'slug', 'value', 'id'):
+            if value.get(key) is not None:
+                return value[key]
+        return dumps(value)
+    if isinstance(value, list):
+        return ','.join(unicode(_group_key(v)) for v in value)
+    return value
+
+def _aggregate_spec(spec):
+    """_aggregate_spec
+
+    Returns a tuple (function, path) from an aggregate written as
+    'function' or 'function:dotted.path', such as 'count' or
+    'sum:vcpus'.
+
+    :param spec: string, or tuple (function, path)
+    """
+    if isinstance(spec, basestring):
+        func, _, path = spec.partition(':')
+        spec = (func, path or None)
+    func, path = spec
+    if func not in AGGREGATES:
+        raise ValueError("Unknown aggregate: {}".format(func))
+    if func != 'count' and not path:
+        raise ValueError("Aggregate {} needs a field".format(func))
+    return func, path
+
+
+class GroupBy(object):
+    """GroupBy
+
+    Groups objects by the value of a dotted path while they are added,
+    and computes aggregates over each group in the same pass. Only the
+    aggregates are kept: count and sum take constant memory per group,
+    distinct one entry per distinct value, and list one per object.
+    """
+
+    def __init__(self, by, aggregates=None, default=None):
+        """__init__
+
+        :param by: string, dotted path of the grouping field, such as
+        'site.name' or 'status'
+        :param aggregates: dict of aggregates by output name, each one
+        being 'count', or 'list', 'distinct' or 'sum' followed by ':' and
+        a dotted path (default {'count': 'count'})
+        :param default: key of the group of objects without the field
+        """
+        if aggregates is None:
+            aggregates = {'count': 'count'}
+        self.by = by
+        self.default = default
+        self.aggregates = dict(
+            (name, _aggregate_spec(spec)) for name, spec in aggregates.items()
+        )
+        self.groups = {}
+
+    def __new_group(self):
+        group = {}
+        for name, (func, path) in self.aggregates.items():
+            if func == 'list':
+                group[name] = []
+            elif func == 'distinct':
+                group[name] = set()
+            else:
+                group[name] = 0
+        return group
+
+    def add(self, elmt):
+        """add
+
+        Accounts for one object.
+
+        :param elmt: dict (or record), object returned by the api
+        """
+        key = _group_key(resolve(elmt, self.by, self.default))
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = self.__new_group()
+        for name, (func, path) in self.aggregates.items():
+            if func == 'count':
+                group[name] += 1
+                continue
+            value = resolve(elmt, path)
+            if value is None:
+                continue
+            if func == 'list':
+                group[name].append(value)
+            elif func == 'distinct':
+                group[name].add(_group_key(value))
+            else:
+                group[name] += value
+
+    def update(self, elements):
+        """update
+
+        Accounts for all the objects of an iterable, such as the one
+        returned by iter_list.
+
+        :param elements: iterable of objects
+        """
+        for elmt in elements:
+            self.add(elmt)
+        return self
+
+    def result(self):
+        """result
+
+        Returns the aggregates of each group, as a dict by group key.
+        Distinct values are returned as sorted lists.
+        """
+        res = {}
+        for key, group in self.groups.items():
+            res[key] = dict(
+                (name, sorted(value) if isinstance(value, set) else value)
+                for name, value in group.items()
+            )
+        return res
+
+
+def group_by(elements, by, aggregates=None, default=None):
+    """group_by
+
+    Groups objects by the value of a dotted path, and returns the
+    aggregates of each group (see GroupBy).
+
+    :param elements: iterable of objects, such as the one returned by
+    iter_list
+    :param by: string, dotted path of the grouping field
+    :param aggregates: dict of aggregates by output name
+    :param default: key of the group of objects without the field
+    """
+    return GroupBy(by, aggregates, default).update(elements).result()
+
+def group(api, model, obj, by=None, aggregate=None, output='json',
+          **kwargs):
+    """group
+
+    Displays the aggregates of all instances of an object grouped by a
+    field. Only the fields needed are asked to the server.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param by: string, dotted path of the grouping field
+    :param aggregate: list of aggregates ('count', 'list:name',
+    'distinct:site.name', 'sum:vcpus'), each one displayed under its own
+    name (default ['count'])
+    :param output: string, display format (see print_json)
+    :param **kwargs: passed to iter_list
+    """
+    if not by:
+        raise ValueError("A field to group by is needed")
+    aggregates = dict((spec, spec) for spec in aggregate or ['count'])
+    fields = [by] + [
+        path for func, path in map(_aggregate_spec, aggregates.values())
+        if path
+    ]
+    kwargs['fields'] = fields
+    res = group_by(
+        iter_list(api, model, obj, **kwargs), by, aggregates,
+        default='unclassified'
+    )
+    print_json(res, output)
+    return res
+
 def get_list_grouped_by_tenant(api, model, obj, **kwargs):
     """get_list_grouped_by_tenant
 
+    Returns the names of all instances of an object grouped by the name
+    of their tenant, as {tenant: {'hosts': [names]}}, the instances
+    without tenant being in the 'unclassified' group.
+
     :param api: Api object
     :param model: string, tells which data model to use
     :param obj: string tells which object to use
-    :param **kwargs:
+    :param **kwargs: passed to iter_list
     """
-    res = get_list(api, model, obj)
-    by_tenants = {}
-    for dev in res['results']:
-        if 'tenant' in dev and dev['tenant']:
-            if dev['tenant']['name'] not in by_tenants.keys():
-                by_tenants[dev['tenant']['name']] = {}
-                by_tenants[dev['tenant']['name']]['hosts'] = []
-            by_tenants[dev['tenant']['name']]['hosts'].append(dev['name'])
-        else:
-            if 'unclassified' not in by_tenants.keys():
-                by_tenants['unclassified'] = { 'hosts': [] }
-            by_tenants['unclassified']['hosts'].append(dev['name'])
-    return by_tenants
+    kwargs['fields'] = ['name', 'tenant.name']
+    return group_by(
+        iter_list(api, model, obj, **kwargs), 'tenant.name',
+        {'hosts': 'list:name'}, default='unclassified'
+    )
 
-def create(api, model, obj, data, ident=None, name=None):
+def create(api, model, obj, data, ident=None, name=None, **kwargs):
     """create
 
 	Creates an object.
@@ -313,16 +1482,17 @@ def create(api, model, obj, data, ident=None, name=None):
     :param data: dict, containing data for the object we create
     :param ident: int, numerical identifier of the object
     :param name: string, name of the object
+    :param **kwargs:
     """
     res = None
     if model and obj and data:
-        res = api.post(
+        res = loads(api.post(
             path="{}/{}/".format(model, obj),
             payload=data
-        ).json()
+        ).content)
     return res
 
-def delete(api, model, obj, ident=None, name=None):
+def delete(api, model, obj, ident=None, name=None, **kwargs):
     """delete
 
     Calls api object delete function in order to delete an object.
@@ -333,6 +1503,7 @@ def delete(api, model, obj, ident=None, name=None):
     :param obj: string tells which object to use
     :param ident: int, numerical identifier of the object
     :param name: string, name of the object
+    :param **kwargs:
     """
     if (ident is None) and name is not None:
         ident = api.get_id_by_name("{}/{}".format(
@@ -341,11 +1512,11 @@ def delete(api, model, obj, ident=None, name=None):
     res = api.delete(
         path="{}/{}/{}".format(model, obj, ident)
     )
-    # Response.json() raises an exception when there is no data,
+    # Decoding raises an exception when there is no data,
     # and it seems normal: https://github.com/requests/requests/issues/4186
     result = None
     try:
-        result = res.json()
+        result = loads(res.content)
     except ValueError:
         result = res.text
     return result
@@ -377,7 +1548,7 @@ def update(api, model, obj, data, ident=None, name=None, **kwargs):
         payload=data
     )
     try:
-        result = res.json()
+        result = loads(res.content)
     except ValueError:
         result = res.text
     return result
@@ -407,7 +1578,476 @@ def patch(api, model, obj, data, ident=None, name=None, **kwargs):
         payload=data
     )
     try:
-        result = res.json()
+        result = loads(res.content)
     except ValueError:
         result = res.text
     return result
+
+def _bulk_results(res, chunk):
+    """_bulk_results
+
+    Returns one result per object of chunk, from the reply to a bulk
+    request. A result is a dict with an 'ok' key, and either the object
+    returned by netbox under 'object', or the object sent and the error
+    under 'object' and 'error'.
+
+    :param res: Response object
+    :param chunk: list of the objects sent
+    """
+    if res is None:
+        return [
+            {'ok': False, 'object': o, 'error': "No reply."} for o in chunk
+        ]
+    try:
+        content = loads(res.content)
+    except ValueError:
+        content = res.text
+    if res.status_code < 300:
+        if isinstance(content, list) and len(content) == len(chunk):
+            return [{'ok': True, 'object': o} for o in content]
+        return [{'ok': True, 'object': o} for o in chunk]
+    # Netbox validates all objects and reports errors in the same order
+    if isinstance(content, list) and len(content) == len(chunk):
+        return [
+            {'ok': False, 'object': o, 'error': e}
+            for o, e in zip(chunk, content)
+        ]
+    return [{'ok': False, 'object': o, 'error': content} for o in chunk]
+
+def _with_ids(api, model, obj, data):
+    """_with_ids
+
+    Yields the objects of data with their 'id' key set, looking it up from
+    their 'name' key if needed. Plain ids are turned into {'id': ...}.
+    Objects whose name is not found are yielded without id.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param data: iterable of dicts or ids
+    """
+    for elmt in data:
+        if not isinstance(elmt, dict):
+            elmt = {'id': elmt}
+        elif 'id' not in elmt and 'name' in elmt:
+            ident = api.get_id_by_name(
+                "{}/{}".format(model, obj), elmt['name']
+            )
+            if ident is not None:
+                elmt = dict(elmt, id=ident)
+        yield elmt
+
+def _bulk_known(chunk, send):
+    """_bulk_known
+
+    Returns one result per object of chunk (see _bulk_results). Only the
+    objects with an id are sent, as netbox would reject the whole list
+    for the others, which fail as not found.
+
+    :param chunk: list of dicts
+    :param send: function sending a list of objects with ids, and
+    returning their results
+    """
+    known = [o for o in chunk if 'id' in o]
+    results = iter(send(known) if known else ())
+    return [
+        next(results) if 'id' in o else
+        {'ok': False, 'object': o, 'error': "Not found."}
+        for o in chunk
+    ]
+
+def bulk_create(api, model, obj, data, batch_size=100, **kwargs):
+    """bulk_create
+
+    Creates objects, sending them by lists of batch_size objects.
+    Returns a list with one result per object (see _bulk_results).
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param data: iterable of dicts, containing data for the objects
+    :param batch_size: int, number of objects sent per request
+    :param **kwargs:
+    """
+    results = []
+    for chunk in _chunks(data, batch_size):
+        res = api.post(
+            path="{}/{}/".format(model, obj),
+            payload=chunk
+        )
+        results.extend(_bulk_results(res, chunk))
+    return results
+
+def bulk_update(api, model, obj, data, batch_size=100, partial=True,
+                **kwargs):
+    """bulk_update
+
+    Updates objects, sending them by lists of batch_size objects. Each
+    object is selected by its 'id' key, or by its 'name' key otherwise.
+    Returns a list with one result per object (see _bulk_results).
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param data: iterable of dicts, containing data for the objects
+    :param batch_size: int, number of objects sent per request
+    :param partial: bool, if True only the given fields are changed
+    (patch), otherwise all required fields have to be given (update)
+    :param **kwargs:
+    """
+    send = api.patch if partial else api.put
+    results = []
+    for chunk in _chunks(_with_ids(api, model, obj, data), batch_size):
+        results.extend(_bulk_known(chunk, lambda known: _bulk_results(
+            send(path="{}/{}".format(model, obj), payload=known), known
+        )))
+    return results
+
+def bulk_delete(api, model, obj, data, batch_size=100, **kwargs):
+    """bulk_delete
+
+    Deletes objects, sending them by lists of batch_size objects. Each
+    object is given as an id, or a dict with an 'id' or a 'name' key.
+    Returns a list with one result per object (see _bulk_results).
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param data: iterable of ids or dicts
+    :param batch_size: int, number of objects sent per request
+    :param **kwargs:
+    """
+    results = []
+    for chunk in _chunks(_with_ids(api, model, obj, data), batch_size):
+        results.extend(_bulk_known(chunk, lambda known: _bulk_results(
+            api.delete(
+                path="{}/{}/".format(model, obj),
+                payload=[{'id': o['id']} for o in known]
+            ), known
+        )))
+    return results
+
+def bulk(api, model, obj, mode, data=None, file=None, batch_size=100,
+         **kwargs):
+    """bulk
+
+    Creates, updates or deletes the objects read from a file or given as
+    data. Displays one result per line and returns the number of objects
+    that could not be processed.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param mode: string, 'create', 'update', 'patch' or 'delete'
+    :param data: list of objects, used if file is not given
+    :param file: string, path of a file read with read_objects
+    :param batch_size: int, number of objects sent per request
+    :param **kwargs:
+    """
+    if file is not None:
+        data = read_objects(file)
+    elif data is None:
+        raise ValueError("The objects are given with data or file.")
+    elif isinstance(data, dict):
+        data = [data]
+    if mode == 'create':
+        results = bulk_create(api, model, obj, data, batch_size)
+    elif mode == 'delete':
+        results = bulk_delete(api, model, obj, data, batch_size)
+    else:
+        results = bulk_update(
+            api, model, obj, data, batch_size, partial=(mode == 'patch')
+        )
+    failed = 0
+    for res in results:
+        print_ndjson(res)
+        if not res['ok']:
+            failed += 1
+    return failed
+
+def _matches(desired, current):
+    """_matches
+
+    Tells if a value of a desired object is the one netbox holds. Nested
+    objects match their id, choices their value, dicts the current dict
+    having the same values for their keys, and lists the current list
+    holding matching elements, in any order.
+
+    :param desired: value as sent to netbox
+    :param current: value as returned by netbox
+    """
+    if isinstance(desired, dict):
+        return isinstance(current, dict) and all(
+            k in current and _matches(v, current[k])
+            for k, v in desired.items()
+        )
+    if isinstance(desired, (list, tuple)):
+        return isinstance(current, list) and \
+            len(desired) == len(current) and all(
+                any(_matches(d, c) for c in current) for d in desired
+            )
+    if isinstance(current, dict) and desired is not None:
+        if 'id' in current:
+            return desired == current['id']
+        if 'value' in current:
+            return desired == current['value']
+        return False
+    return desired == current
+
+def diff(desired, current):
+    """diff
+
+    Returns the fields of desired whose values differ from the ones of
+    current, as a dict.
+
+    :param desired: dict, object as sent to netbox
+    :param current: dict, object as returned by netbox
+    """
+    return dict(
+        (k, v) for k, v in desired.items()
+        if k != 'id' and (k not in current or not _matches(v, current[k]))
+    )
+
+def plan(api, model, obj, data, key='name', delete_missing=False,
+         filters=None, workers=1, **kwargs):
+    """plan
+
+    Compares the desired state of objects with the current one, read in a
+    single pass, and returns the changes needed as a dict: the objects to
+    'create', the fields to 'patch' (with the ids of the objects), the
+    ids to 'delete', and the number of objects 'unchanged'.
+
+    Desired objects are matched with current ones by id, or by their key
+    field otherwise, raising ValueError if several current objects have
+    the key of a desired one. Only the objects of the desired state are read,
+    unless delete_missing is set or the key is not the name: the whole
+    endpoint (or the objects matching filters) is read then.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param data: iterable of dicts, desired objects
+    :param key: string, field identifying objects without id ('name',
+    'slug', 'model'...)
+    :param delete_missing: bool, deletes the current objects (matching
+    filters) that are not in the desired state
+    :param filters: dict of netbox filters restricting the current objects
+    read, see iter_list
+    :param workers: int, number of requests sent at the same time when
+    reading the current objects
+    :param **kwargs:
+    """
+    desired = []
+    keys = set()
+    for elmt in data:
+        ident = ('id', elmt['id']) if 'id' in elmt else (key, elmt.get(key))
+        if ident[1] is None:
+            raise ValueError(
+                "Object without id nor {}: {}".format(key, dumps(elmt))
+            )
+        if ident in keys:
+            raise ValueError("Object given twice: {}={}".format(*ident))
+        keys.add(ident)
+        desired.append((ident, elmt))
+
+    if delete_missing or key not in ('id', 'name'):
+        current = list(iter_list(
+            api, model, obj, page_size=1000, workers=workers, filters=filters
+        ))
+    else:
+        current = [e for _, e in iter_many(
+            api, model, obj,
+            idents=[v for k, v in keys if k == 'id'],
+            names=[v for k, v in keys if k != 'id'], workers=workers,
+            # Names the filter does not find are objects to create
+            lookup_names=False
+        )]
+    by_key = {}
+    shared = set()
+    for elmt in current:
+        by_key[('id', elmt['id'])] = elmt
+        if elmt.get(key) is not None:
+            other = by_key.get((key, elmt[key]))
+            if other is not None and other['id'] != elmt['id']:
+                shared.add((key, elmt[key]))
+            by_key[(key, elmt[key])] = elmt
+
+    changes = {'create': [], 'patch': [], 'delete': [], 'unchanged': 0}
+    matched = set()
+    for ident, elmt in desired:
+        if ident in shared:
+            raise ValueError(
+                "Several objects have {}={}: give their id, or choose a "
+                "unique key.".format(*ident)
+            )
+        existing = by_key.get(ident)
+        if existing is None:
+            changes['create'].append(elmt)
+            continue
+        matched.add(existing['id'])
+        fields = diff(elmt, existing)
+        if fields:
+            fields['id'] = existing['id']
+            changes['patch'].append(fields)
+        else:
+            changes['unchanged'] += 1
+    if delete_missing:
+        changes['delete'] = [
+            e['id'] for e in current if e['id'] not in matched
+        ]
+    return changes
+
+def apply(api, model, obj, data=None, file=None, key='name',
+          delete_missing=False, filters=None, dry_run=False, batch_size=100,
+          workers=1, **kwargs):
+    """apply
+
+    Brings objects to the desired state read from a file or given as
+    data: computes the changes with plan, then deletes, patches and
+    creates objects by batches. Nothing is sent for objects already in
+    the desired state. Displays one result per line (see _bulk_results)
+    with its 'action', and returns the number of changes that failed.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string, tells which object to use
+    :param data: list of objects, used if file is not given
+    :param file: string, path of a file read with read_objects
+    :param key: string, field identifying objects without id
+    :param delete_missing: bool, deletes the objects that are not in the
+    desired state
+    :param filters: dict of netbox filters restricting the objects
+    managed, see plan
+    :param dry_run: bool, only displays the changes
+    :param batch_size: int, number of objects sent per request
+    :param workers: int, number of requests sent at the same time when
+    reading the current objects
+    :param **kwargs:
+    """
+    if file is not None:
+        data = read_objects(file)
+    elif isinstance(data, dict):
+        data = [data]
+    changes = plan(
+        api, model, obj, data, key=key, delete_missing=delete_missing,
+        filters=filters, workers=workers
+    )
+    if dry_run:
+        for action in ('delete', 'patch', 'create'):
+            for elmt in changes[action]:
+                print_ndjson({'action': action, 'object': elmt})
+        return 0
+    failed = 0
+    for action, send in (('delete', bulk_delete), ('patch', bulk_update),
+                         ('create', bulk_create)):
+        if not changes[action]:
+            continue
+        for res in send(api, model, obj, changes[action], batch_size):
+            res['action'] = action
+            print_ndjson(res)
+            if not res['ok']:
+                failed += 1
+    return failed
+
+def _list(api, model, obj, **kwargs):
+    """_list
+
+    Returns all instances of an object, as a list.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param **kwargs: passed to iter_list
+    """
+    return list(iter_list(api, model, obj, **kwargs))
+
+# Functions run by batch, by action name
+BATCH_ACTIONS = {
+    'show': get,
+    'list': _list,
+    'create': create,
+    'update': update,
+    'patch': patch,
+    'delete': delete,
+}
+
+def _batch_operation(api, status, number, line):
+    """_batch_operation
+
+    Runs the operation of one line of a batch and returns its result, a
+    dict with the line number, an 'ok' key, the highest http status of
+    the requests sent (of their last attempt when they have been retried),
+    and either the result of the action or an error.
+
+    :param api: Api object
+    :param status: threading.local object the status of the requests is
+    recorded in
+    :param number: int, line number
+    :param line: string, json operation
+    """
+    res = {'line': number, 'ok': False}
+    status.code = 0
+    try:
+        op = loads(line)
+        if not isinstance(op, dict):
+            raise ValueError("An operation is a json object.")
+        action = op.pop('action')
+        if action not in BATCH_ACTIONS:
+            raise ValueError("Unknown action: {}".format(action))
+        if 'id' in op:
+            op['ident'] = op.pop('id')
+        result = BATCH_ACTIONS[action](api, **op)
+    except (ValueError, KeyError, TypeError,
+            requests.exceptions.RequestException) as e:
+        res['error'] = "{}: {}".format(e.__class__.__name__, e)
+        return res
+    res['status'] = status.code
+    res['ok'] = status.code < 400
+    res['result'] = result
+    return res
+
+def batch(api, file='-', workers=1, **kwargs):
+    """batch
+
+    Runs the operations read from a file, one json object per line such
+    as {"action": "patch", "model": "dcim", "obj": "devices", "name":
+    "sw1", "data": {"status": "active"}}. Actions are the keys of
+    BATCH_ACTIONS, the other keys being given to their function ('id'
+    as ident). Displays one result per line, in the order of the
+    operations, and returns the number of operations that failed.
+
+    :param api: Api object
+    :param file: string, path of the file, or '-' for stdin
+    :param workers: int, number of operations run at the same time
+    :param **kwargs:
+    """
+    status = threading.local()
+
+    def record(method, url, reply, elapsed, error):
+        code = reply.status_code if reply is not None else 599
+        status.previous = getattr(status, 'code', 0)
+        status.code = max(status.previous, code)
+
+    def forget(method, url, attempt, delay):
+        # The attempt that failed is sent again: only the last one counts
+        status.code = status.previous
+
+    def run(item):
+        return _batch_operation(api, status, item[0], item[1])
+
+    fd = sys.stdin if file == '-' else open(file)
+    api.add_hook('post_request', record)
+    api.add_hook('retry', forget)
+    failed = 0
+    try:
+        lines = ((n, l) for n, l in enumerate(fd, 1) if l.strip())
+        for res in _ordered_map(run, lines, workers):
+            print_ndjson(res)
+            if not res['ok']:
+                failed += 1
+    finally:
+        api.remove_hook('post_request', record)
+        api.remove_hook('retry', forget)
+        if fd is not sys.stdin:
+            fd.close()
+    return failed
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+
+"""
+Compact, read-only representation of netbox objects.
+
+Objects decoded from json are dicts of dicts, each one holding its own
+copy of its keys, of its repeated values and of the objects it refers
+to. A Registry turns them into records instead: instances of classes
+with __slots__, generated for each endpoint and set of fields, whose
+field names and repeated values are shared. References to other objects (the site of a device,
+its tenant...) are Ref objects, kept once per object by the registry and
+loaded from the api only when a field they do not carry is read.
+"""
+
+import re
+import threading
+from urlparse import urlparse
+from codec import loads
+
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Maximum number of strings shared by a registry
+MAX_STRINGS = 10000
+
+
+def _ref_endpoint(value):
+    """_ref_endpoint
+
+    Returns the 'app/endpoint' an object refers to, if value is a nested
+    representation of a netbox object (a dict with an id and an url),
+    None otherwise.
+
+    :param value: any decoded json value
+    """
+    if not isinstance(value, dict) or 'id' not in value or \
+            not isinstance(value.get('url'), basestring):
+        return None
+    path = urlparse(value['url']).path
+    if '/api/' not in path:
+        return None
+    parts = [p for p in path.split('/api/', 1)[1].split('/') if p]
+    if len(parts) < 3:
+        return None
+    return '/'.join(parts[:2])
+
+
+class Record(object):
+    """Record
+
+    Base class of the generated record classes. Fields are read as
+    attributes, or as keys for compatibility with dicts.
+    """
+
+    __slots__ = ()
+    _endpoint = None
+    _fields = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return "<{} {}>".format(
+            self._endpoint,
+            ' '.join("{}={!r}".format(f, getattr(self, f))
+                     for f in self._fields[:4])
+        )
+
+    def get(self, key, default=None):
+        """get
+
+        Returns the value of a field, or default.
+
+        :param key: string, name of the field
+        :param default: returned if the record has no such field
+        """
+        if key not in self._fields:
+            return default
+        return getattr(self, key)
+
+    def _asdict(self):
+        """_asdict
+
+        Returns the record as decoded json data, references included as
+        far as they are known.
+        """
+        return dict((f, _asdict(getattr(self, f))) for f in self._fields)
+
+
+class Ref(object):
+    """Ref
+
+    Reference to a netbox object. The fields of the nested representation
+    (id, name, slug...) are read directly; reading any other field loads
+    the complete object once, through the registry.
+    """
+
+    __slots__ = ('id', '_endpoint', '_brief', '_registry')
+
+    def __init__(self, registry, endpoint, ident, brief):
+        self.id = ident
+        self._endpoint = endpoint
+        self._brief = brief
+        self._registry = registry
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in self._brief._fields:
+            return getattr(self._brief, name)
+        return getattr(self._registry.load(self._endpoint, self.id), name)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return "<Ref {} {}>".format(self._endpoint, self.id)
+
+    def get(self, key, default=None):
+        """get
+
+        Returns the value of a field, or default.
+
+        :param key: string, name of the field
+        :param default: returned if the object has no such field
+        """
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            return default
+
+    def resolve(self):
+        """resolve
+
+        Returns the complete object as a record.
+        """
+        return self._registry.load(self._endpoint, self.id)
+
+    def _asdict(self):
+        """_asdict
+
+        Returns the nested representation of the object as decoded json
+        data.
+        """
+        return self._brief._asdict()
+
+
+def _asdict(value):
+    if isinstance(value, (Record, Ref)):
+        return value._asdict()
+    if isinstance(value, tuple):
+        return [_asdict(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _asdict(v)) for k, v in value.items())
+    return value
+
+
+class Registry(object):
+    """Registry
+
+    Builds records and keeps the identity map of the objects referred
+    to: each one is represented by one Ref, and loaded at most once. The
+    records built from the objects read are not kept, so that streaming
+    them through a registry takes constant memory. A registry is meant
+    to be shared by the calls building a data set, and dropped with it.
+    """
+
+    def __init__(self, api=None, max_strings=MAX_STRINGS):
+        """__init__
+
+        :param api: Api object used to load the objects references point
+        to, None to only use the objects already seen
+        :param max_strings: int, maximum number of strings shared, the
+        others being kept as they are
+        """
+        self.api = api
+        self.max_strings = max_strings
+        self.__classes = {}
+        self.__strings = {}
+        self.__values = {}
+        self.__refs = {}
+        self.__objects = {}
+        self.__lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.__objects)
+
+    @property
+    def strings(self):
+        """strings
+
+        Number of strings shared by the registry.
+        """
+        return len(self.__strings)
+
+    def record_class(self, endpoint, fields):
+        """record_class
+
+        Returns the record class of an endpoint for a tuple of field
+        names, generating it the first time.
+
+        :param endpoint: string, 'app/endpoint'
+        :param fields: tuple of strings
+        """
+        key = (endpoint, fields)
+        cls = self.__classes.get(key)
+        if cls is None:
+            name = ''.join(
+                p.capitalize() for p in re.split(r'[^A-Za-z0-9]', endpoint) if p
+            ) or 'Record'
+            cls = type(str(name), (Record,), {
+                '__slots__': tuple(str(f) for f in fields),
+                '_endpoint': endpoint,
+                '_fields': fields,
+            })
+            self.__classes[key] = cls
+        return cls
+
+    def intern(self, value):
+        """intern
+
+        Returns the copy of value already held by the registry, if any.
+        Values are held until max_strings of them are.
+
+        :param value: string
+        """
+        res = self.__strings.get(value)
+        if res is None:
+            res = value
+            if len(self.__strings) < self.max_strings:
+                self.__strings[value] = value
+        return res
+
+    def __convert(self, endpoint, value, shared=True):
+        if isinstance(value, basestring):
+            return self.intern(value) if shared else value
+        if isinstance(value, list):
+            return tuple(self.__convert(endpoint, v, shared) for v in value)
+        if not isinstance(value, dict):
+            return value
+        ref_endpoint = _ref_endpoint(value)
+        if ref_endpoint is not None:
+            return self.ref(ref_endpoint, value)
+        if not all(IDENTIFIER.match(k) for k in value):
+            # Custom fields and the like keep their arbitrary keys
+            return dict(
+                (self.intern(k), self.__convert(endpoint, v, shared))
+                for k, v in value.items()
+            )
+        rec = self.__build(endpoint, value)
+        if all(not isinstance(v, (list, dict)) for v in value.values()):
+            # Choices such as status are shared between objects
+            key = (rec.__class__, tuple(getattr(rec, f) for f in rec._fields))
+            rec = self.__values.setdefault(key, rec)
+        return rec
+
+    def __build(self, endpoint, elmt, shared=True):
+        fields = tuple(self.intern(k) for k in sorted(elmt))
+        cls = self.record_class(endpoint, fields)
+        rec = cls.__new__(cls)
+        for f in fields:
+            setattr(rec, f, self.__convert(
+                "{}.{}".format(endpoint, f), elmt[f], shared
+            ))
+        return rec
+
+    def ref(self, endpoint, nested):
+        """ref
+
+        Returns the Ref of the object described by a nested
+        representation.
+
+        :param endpoint: string, 'app/endpoint' of the object
+        :param nested: dict, with at least an id
+        """
+        key = (endpoint, nested['id'])
+        with self.__lock:
+            ref = self.__refs.get(key)
+            if ref is None:
+                ref = Ref(
+                    self, endpoint, nested['id'],
+                    self.__build("{}#nested".format(endpoint), nested)
+                )
+                self.__refs[key] = ref
+        return ref
+
+    def record(self, endpoint, elmt):
+        """record
+
+        Returns elmt, an object of endpoint decoded from json, as a
+        record.
+
+        :param endpoint: string, 'app/endpoint'
+        :param elmt: dict
+        """
+        # The strings of the object itself (name, serial, url...) are
+        # mostly unique: only the ones of nested objects and choices are
+        # shared
+        with self.__lock:
+            return self.__build(endpoint, elmt, shared=False)
+
+    def load(self, endpoint, ident):
+        """load
+
+        Returns the record of an object, fetching it from the api if it
+        has not been loaded yet. Loaded objects are kept in the identity
+        map.
+
+        :param endpoint: string, 'app/endpoint'
+        :param ident: int, id of the object
+        """
+        rec = self.__objects.get((endpoint, ident))
+        if rec is None:
+            if self.api is None:
+                raise AttributeError(
+                    "{} {} is not loaded".format(endpoint, ident)
+                )
+            rec = self.record(endpoint, loads(
+                self.api.get("{}/{}".format(endpoint, ident)).content
+            ))
+            with self.__lock:
+                rec = self.__objects.setdefault((endpoint, ident), rec)
+        return rec
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import random
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+
+
+class RetryPolicy(object):
+    """RetryPolicy
+
+    Tells whether a failed request should be sent again, and how long to
+    wait before doing so. Requests are only sent again when that is safe:
+
+    - replies with a status in status_forcelist, and connection errors,
+      are retried for the idempotent methods only, since a POST may have
+      been processed before the failure,
+    - 429 (Too Many Requests) replies and connection timeouts are retried
+      for all methods, since the server did not process the request.
+
+    The delay is the one asked by the Retry-After header of the reply if
+    any, an exponential backoff otherwise, and at most max_backoff.
+    """
+
+    def __init__(self, retries=3, backoff_factor=0.5, max_backoff=30,
+                 jitter=True, status_forcelist=(429, 502, 503, 504),
+                 methods=('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')):
+        """__init__
+
+        :param retries: int, maximum number of times a request is sent
+        again, 0 disables retries
+        :param backoff_factor: float, the delay before the nth retry is
+        backoff_factor * 2 ** (n - 1) seconds
+        :param max_backoff: float, maximum delay in seconds, the one asked
+        by Retry-After included
+        :param jitter: bool, if True the backoff delay is a random value
+        between 0 and the computed one, so that clients do not retry all
+        at the same time
+        :param status_forcelist: status codes on which requests are retried
+        :param methods: http methods that are safe to send again
+        """
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.status_forcelist = status_forcelist
+        self.methods = methods
+
+    def is_retryable(self, method, reply=None, error=None):
+        """is_retryable
+
+        Returns True if a request that got reply, or raised error, should
+        be sent again.
+
+        :param method: string, http method
+        :param reply: Response object, or None
+        :param error: exception raised by the request, or None
+        """
+        if reply is not None:
+            if reply.status_code == 429:
+                return True
+            return reply.status_code in self.status_forcelist and \
+                method in self.methods
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        return isinstance(error, (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout
+        )) and method in self.methods
+
+    def delay(self, attempt, reply=None):
+        """delay
+
+        Returns the number of seconds to wait before sending a request
+        again.
+
+        :param attempt: int, number of retries already done
+        :param reply: Response object, or None
+        """
+        if reply is not None and 'Retry-After' in reply.headers:
+            retry_after = reply.headers['Retry-After']
+            try:
+                return min(self.max_backoff, max(0, int(retry_after)))
+            except ValueError:
+                date = parsedate_tz(retry_after)
+                if date is not None:
+                    return min(
+                        self.max_backoff,
+                        max(0, mktime_tz(date) - time.time())
+                    )
+        backoff = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        if self.jitter:
+            return random.uniform(0, backoff)
+        return backoff
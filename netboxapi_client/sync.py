@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+import hashlib
+import os
+import sqlite3
+import time
+from netboxapi_client import iter_list, print_json
+from cache import default_cache_dir
+from codec import loads, dumps
+
+
+class SnapshotStore(object):
+    """SnapshotStore
+
+    Local copy of the objects of netbox endpoints, kept in a sqlite
+    database along with the most recent last_updated value seen for each
+    endpoint (its high-water mark).
+    """
+
+    def __init__(self, path):
+        """__init__
+
+        :param path: string, path of the sqlite database (created if it
+        does not exist)
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (
+                endpoint TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                last_updated TEXT,
+                data TEXT NOT NULL,
+                PRIMARY KEY (endpoint, id)
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                endpoint TEXT PRIMARY KEY,
+                high_water TEXT,
+                synced_at REAL NOT NULL
+            );
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """close
+
+        Closes the database.
+        """
+        self.db.close()
+
+    def put(self, endpoint, elmt):
+        """put
+
+        Stores or replaces an object.
+
+        :param endpoint: string, 'model/obj'
+        :param elmt: dict, object returned by the api
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+            (endpoint, elmt['id'], elmt.get('last_updated'), dumps(elmt))
+        )
+
+    def delete(self, endpoint, idents):
+        """delete
+
+        Drops objects.
+
+        :param endpoint: string, 'model/obj'
+        :param idents: iterable of ids
+        """
+        self.db.executemany(
+            "DELETE FROM objects WHERE endpoint = ? AND id = ?",
+            ((endpoint, i) for i in idents)
+        )
+
+    def get(self, endpoint, ident):
+        """get
+
+        Returns the stored object, or None.
+
+        :param endpoint: string, 'model/obj'
+        :param ident: int, id of the object
+        """
+        row = self.db.execute(
+            "SELECT data FROM objects WHERE endpoint = ? AND id = ?",
+            (endpoint, ident)
+        ).fetchone()
+        return loads(row[0]) if row else None
+
+    def iter(self, endpoint):
+        """iter
+
+        Yields the stored objects of an endpoint, by id.
+
+        :param endpoint: string, 'model/obj'
+        """
+        for row in self.db.execute(
+                "SELECT data FROM objects WHERE endpoint = ? ORDER BY id",
+                (endpoint,)):
+            yield loads(row[0])
+
+    def ids(self, endpoint):
+        """ids
+
+        Returns the set of the ids stored for an endpoint.
+
+        :param endpoint: string, 'model/obj'
+        """
+        return set(row[0] for row in self.db.execute(
+            "SELECT id FROM objects WHERE endpoint = ?", (endpoint,)
+        ))
+
+    def count(self, endpoint):
+        """count
+
+        Returns the number of objects stored for an endpoint.
+
+        :param endpoint: string, 'model/obj'
+        """
+        return self.db.execute(
+            "SELECT COUNT(*) FROM objects WHERE endpoint = ?", (endpoint,)
+        ).fetchone()[0]
+
+    def state(self, endpoint):
+        """state
+
+        Returns a tuple (high_water, synced_at) for an endpoint, or None
+        if it has never been synchronized.
+
+        :param endpoint: string, 'model/obj'
+        """
+        return self.db.execute(
+            "SELECT high_water, synced_at FROM state WHERE endpoint = ?",
+            (endpoint,)
+        ).fetchone()
+
+    def set_state(self, endpoint, high_water):
+        """set_state
+
+        Records that an endpoint has been synchronized.
+
+        :param endpoint: string, 'model/obj'
+        :param high_water: string, most recent last_updated value seen
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+            (endpoint, high_water, time.time())
+        )
+
+
+def remote_count(api, model, obj):
+    """remote_count
+
+    Returns the number of objects of an endpoint, asking for one object.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    """
+    return loads(
+        api.get("{}/{}".format(model, obj), "?limit=1").content
+    )['count']
+
+
+def sync(api, model, obj, store, page_size=100, workers=1):
+    """sync
+
+    Brings the snapshot of an endpoint up to date. Only the objects
+    updated since the last synchronization are fetched (last_updated__gte
+    filter). Every object that still exists was either stored before or
+    has just been fetched, so objects have been deleted only if the
+    snapshot holds more objects than netbox: the ids are only compared in
+    that case. Endpoints without last_updated are fetched completely.
+
+    Returns a dict with the number of objects 'updated' and 'deleted',
+    and the new 'high_water' mark.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param store: SnapshotStore object
+    :param page_size: int, number of objects requested per page
+    :param workers: int, number of pages fetched at the same time
+    """
+    endpoint = "{}/{}".format(model, obj)
+    state = store.state(endpoint)
+    high_water = state[0] if state else None
+    # Objects updated while pages are read move to the last page
+    filters = {'ordering': 'last_updated'}
+    if high_water is not None:
+        filters['last_updated__gte'] = high_water
+
+    updated = 0
+    deleted = set()
+    with store.db:
+        for elmt in iter_list(api, model, obj, page_size=page_size,
+                              workers=workers, filters=filters):
+            store.put(endpoint, elmt)
+            updated += 1
+            if elmt.get('last_updated') and \
+                    elmt['last_updated'] > (high_water or ''):
+                high_water = elmt['last_updated']
+
+        if state is not None and \
+                store.count(endpoint) != remote_count(api, model, obj):
+            remote = set(
+                e['id'] for e in iter_list(
+                    api, model, obj, page_size=1000, workers=workers,
+                    brief=True, fields=['id']
+                )
+            )
+            deleted = store.ids(endpoint) - remote
+            store.delete(endpoint, deleted)
+        store.set_state(endpoint, high_water)
+    return {
+        'updated': updated,
+        'deleted': len(deleted),
+        'high_water': high_water
+    }
+
+
+def default_snapshot_path(api):
+    """default_snapshot_path
+
+    Returns the path of the snapshot database of the netbox instance of
+    api, in the cache directory.
+
+    :param api: Api object
+    """
+    return os.path.join(
+        default_cache_dir(),
+        "snapshot-{}.sqlite".format(hashlib.sha1(api.url).hexdigest()[:12])
+    )
+
+
+def snapshot(api, model, obj, snapshot=None, workers=1, **kwargs):
+    """snapshot
+
+    Synchronizes the snapshot of an endpoint and displays the result of
+    sync.
+
+    :param api: Api object
+    :param model: string, tells which data model to use
+    :param obj: string tells which object to use
+    :param snapshot: string, path of the snapshot database (see
+    default_snapshot_path)
+    :param workers: int, number of pages fetched at the same time
+    :param **kwargs:
+    """
+    with SnapshotStore(snapshot or default_snapshot_path(api)) as store:
+        res = sync(api, model, obj, store, workers=workers)
+    print_json(res)
+    return res
@@ -82,6 +82,8 @@ setup(
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
+        'fast': ['ujson'],
+        'parquet': ['pyarrow'],
     },
 
     # If there are data files included in your packages that need to be
@@ -102,6 +104,7 @@ setup(
     entry_points={
         'console_scripts': [
             'netboxapi-client=netboxapi_client:main',
+            'netboxapi-inventory=netboxapi_client.inventory:main',
         ],
     },
 )
@@ -1,7 +1,14 @@
 #!/usr/bin/python
 
+import json
+import tempfile
 import unittest
-from netboxapi_client.netboxapi_client import Api, get_list, create, delete, get, get_list_grouped_by_tenant, update, patch
+from netboxapi_client.netboxapi_client import Api, ApiError, get_list, create, delete, get, get_list_grouped_by_tenant, update, patch, iter_list, bulk_create, bulk_update, bulk_delete, group_by, batch, get_many, apply, plan
+from netboxapi_client.cache import ResponseCache
+from netboxapi_client.records import Registry
+from netboxapi_client.inventory import build_inventory
+from netboxapi_client.export import export_endpoint
+from netboxapi_client.mirror import Mirror
 from pprint import pprint
 
 TOKEN = "8054b0446b7a2c930230058afb126df65e2f64af"
@@ -47,6 +54,58 @@ class BasicTest(unittest.TestCase):
         self.assertTrue(type(res['results']) is list)
         self.assertGreaterEqual(len(res['results']), 1)
 
+    def test_iter_list_follows_pagination(self):
+        """
+        Tests if iter_list yields every object, whatever the page size.
+        """
+        count = get_list(self.__api, model="ipam", obj="aggregates")['count']
+        res = list(iter_list(self.__api, model="ipam", obj="aggregates", page_size=1))
+        self.assertEqual(len(res), count)
+        self.assertEqual(len(set(e['id'] for e in res)), count)
+
+    def test_get_fields(self):
+        site = get_list(self.__api, model="dcim", obj="sites")['results'][0]
+        res = get(
+            self.__api, model="dcim", obj="sites", ident=site['id'],
+            fields=['name', 'tenant.name']
+        )
+        self.assertEqual(res['name'], site['name'])
+        self.assertLessEqual(set(res), set(['name', 'tenant']))
+        if res.get('tenant'):
+            self.assertEqual(res['tenant'].keys(), ['name'])
+
+    def test_iter_list_error(self):
+        with self.assertRaises(ApiError) as ctx:
+            list(iter_list(self.__api, model="dcim", obj="devicez"))
+        self.assertEqual(ctx.exception.status_code, 404)
+
+    def test_get_list_records(self):
+        registry = Registry(self.__api)
+        res = get_list(
+            self.__api, model="dcim", obj="sites", registry=registry
+        )
+        for site in res['results']:
+            self.assertEqual(
+                site.name,
+                get(self.__api, model="dcim", obj="sites", ident=site.id)['name']
+            )
+        # The records read are not kept by the registry
+        self.assertEqual(len(registry), 0)
+
+    def test_get_many(self):
+        sites = get_list(self.__api, model="dcim", obj="sites")['results']
+        idents = [s['id'] for s in sites]
+        names = [s['name'] for s in sites]
+        res = get_many(
+            self.__api, model="dcim", obj="sites",
+            idents=idents + idents + [999999], names=names, chunk_size=2
+        )
+        self.assertEqual(len(res), 2 * len(sites))
+        self.assertNotIn(999999, res)
+        for site in sites:
+            self.assertEqual(res[site['id']]['name'], site['name'])
+            self.assertEqual(res[site['name']]['id'], site['id'])
+
     def test_delete_absent_object(self):
         res = delete(self.__api, model="dcim", obj="sites", ident=1)
         self.assertTrue(type(res) is dict)
@@ -143,6 +202,157 @@ class BasicTest(unittest.TestCase):
             ident=site_id
         )
 
+    def test_group_by_counts_all_objects(self):
+        res = group_by(
+            iter_list(self.__api, model="dcim", obj="sites", page_size=2),
+            'status', {'count': 'count', 'ids': 'list:id'}
+        )
+        count = get_list(self.__api, model="dcim", obj="sites")['count']
+        self.assertEqual(sum(g['count'] for g in res.values()), count)
+        self.assertEqual(sum(len(g['ids']) for g in res.values()), count)
+
+    def test_build_inventory(self):
+        res = build_inventory(self.__api, groups=['site', 'status'])
+        self.assertIn('_meta', res)
+        for group in res['all']['children']:
+            for host in res[group]['hosts']:
+                self.assertIn(host, res['_meta']['hostvars'])
+
+    def test_mirror_find(self):
+        sites = get_list(self.__api, model="dcim", obj="sites")['results']
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as fd:
+            mirror = Mirror(self.__api, ["dcim/sites"], path=fd.name)
+            for site in sites:
+                self.assertEqual(
+                    mirror.find("dcim/sites", name=site['name'])['id'],
+                    site['id']
+                )
+            self.assertIsNone(mirror.find("dcim/sites", name='Ohtae9ek'))
+            mirror.close()
+
+    def test_name_cache_forgets_deleted_object(self):
+        object_name = 'Ohz8eixeeNgoh4a'
+        res = create(
+            self.__api, model="dcim", obj="sites",
+            data={ 'name': object_name, 'slug': object_name }
+        )
+        self.assertEqual(
+            self.__api.get_id_by_name('dcim/sites', object_name), res['id']
+        )
+        delete(
+            self.__api, model="dcim", obj="sites", name=object_name
+        )
+        self.assertIsNone(
+            self.__api.get_id_by_name('dcim/sites', object_name)
+        )
+
+    def test_get_id_by_name_ignores_slugs(self):
+        res = create(
+            self.__api, model="dcim", obj="sites",
+            data={ 'name': 'Ahngoo5Pa', 'slug': 'ahngoo5pa-slug' }
+        )
+        self.assertIsNone(
+            self.__api.get_id_by_name('dcim/sites', 'ahngoo5pa-slug')
+        )
+        delete(self.__api, model="dcim", obj="sites", ident=res['id'])
+
+    def test_response_cache_forgets_patched_object(self):
+        object_name = 'Iequ6aiQuoh1ahr'
+        api = Api(url=URL, token=TOKEN, response_cache=ResponseCache(ttl=60))
+        res = create(
+            api, model="dcim", obj="sites",
+            data={ 'name': object_name, 'slug': object_name }
+        )
+        res = get(api, model="dcim", obj="sites", ident=res['id'])
+        self.assertEqual(
+            get(api, model="dcim", obj="sites", ident=res['id']), res
+        )
+        patch(
+            api, model="dcim", obj="sites", ident=res['id'],
+            data={ 'description': 'cached' }
+        )
+        res = get(api, model="dcim", obj="sites", ident=res['id'])
+        self.assertEqual(res['description'], 'cached')
+        delete(api, model="dcim", obj="sites", ident=res['id'])
+
+    def test_bulk_crud_objects(self):
+        names = ['Eeth4ahm{}'.format(i) for i in range(5)]
+        res = bulk_create(
+            self.__api, model="dcim", obj="sites",
+            data=[{ 'name': n, 'slug': n } for n in names], batch_size=2
+        )
+        self.assertEqual(len(res), 5)
+        self.assertTrue(all(r['ok'] for r in res))
+        ids = [r['object']['id'] for r in res]
+        res = bulk_update(
+            self.__api, model="dcim", obj="sites",
+            data=[{ 'name': n, 'description': 'bulk' } for n in names]
+        )
+        self.assertTrue(all(r['ok'] for r in res))
+        res = get(self.__api, model="dcim", obj="sites", ident=ids[0])
+        self.assertEqual(res['description'], 'bulk')
+        res = bulk_delete(
+            self.__api, model="dcim", obj="sites", data=ids, batch_size=3
+        )
+        self.assertTrue(all(r['ok'] for r in res))
+        self.assertIsNone(self.__api.get_id_by_name('dcim/sites', names[0]))
+
+    def test_batch_operations(self):
+        object_name = 'ooy0Aeka2ohng5i'
+        ops = [
+            {'action': 'create', 'model': 'dcim', 'obj': 'sites',
+             'data': { 'name': object_name, 'slug': object_name }},
+            {'action': 'patch', 'model': 'dcim', 'obj': 'sites',
+             'name': object_name, 'data': { 'description': 'batch' }},
+            {'action': 'delete', 'model': 'dcim', 'obj': 'sites',
+             'name': object_name},
+        ]
+        with tempfile.NamedTemporaryFile(suffix='.ndjson') as fd:
+            fd.write('\n'.join(json.dumps(op) for op in ops))
+            fd.flush()
+            self.assertEqual(batch(self.__api, file=fd.name), 0)
+        # The object does not exist anymore
+        with tempfile.NamedTemporaryFile(suffix='.ndjson') as fd:
+            fd.write('\n'.join(json.dumps(op) for op in ops[1:]))
+            fd.flush()
+            self.assertEqual(batch(self.__api, file=fd.name, workers=2), 2)
+
+    def test_batch_skips_invalid_lines(self):
+        with tempfile.NamedTemporaryFile() as fd:
+            fd.write('5\n["show"]\n{"action": "list", "model": "dcim", "obj": "sites"}\n')
+            fd.flush()
+            self.assertEqual(batch(self.__api, file=fd.name), 2)
+
+    def test_export_endpoint(self):
+        count = get_list(self.__api, model="dcim", obj="sites")['count']
+        with tempfile.NamedTemporaryFile(suffix='.csv') as fd:
+            res = export_endpoint(
+                self.__api, "dcim", "sites", fd.name, format='csv',
+                page_size=1, fields='id,name,tenant.name'
+            )
+            self.assertEqual(res, count)
+            lines = open(fd.name).read().splitlines()
+            self.assertEqual(lines[0], 'id,name,tenant.name')
+            self.assertEqual(len(lines), count + 1)
+
+    def test_apply_desired_state(self):
+        object_name = 'Eech4ohkaiJ6iel'
+        desired = [{
+            'name': object_name, 'slug': object_name, 'description': 'a'
+        }]
+        self.assertEqual(apply(self.__api, "dcim", "sites", desired), 0)
+        self.assertEqual(
+            plan(self.__api, "dcim", "sites", desired)['unchanged'], 1
+        )
+        desired[0]['description'] = 'b'
+        changes = plan(self.__api, "dcim", "sites", desired)
+        self.assertEqual(
+            changes['patch'][0],
+            {'id': get(self.__api, model="dcim", obj="sites",
+                       name=object_name)['id'], 'description': 'b'}
+        )
+        delete(self.__api, model="dcim", obj="sites", name=object_name)
+
     def test_update_object(self):
         object_name = 'aJaid0pei4waj2m'
         new_object_name = 'guta9IneeTei9fa'
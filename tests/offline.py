@@ -0,0 +1,381 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Tests run against the fake netbox server of the benchmarks, started in
+this process: they need no netbox instance.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+from fake_netbox import FakeNetbox, Handler
+from netboxapi_client.netboxapi_client import Api, ApiError, batch, bulk, \
+    bulk_update, get_many, iter_list, plan
+from netboxapi_client.__main__ import main
+from netboxapi_client.asyncapi import AsyncApi, get_async
+from netboxapi_client.cache import ResponseCache, read_json, \
+    write_json_atomic
+from netboxapi_client.codec import dumps, loads
+from netboxapi_client.metrics import Metrics
+from netboxapi_client.records import Registry
+from netboxapi_client.retry import RetryPolicy
+from netboxapi_client.sync import SnapshotStore, sync
+
+TOKEN = "0123456789abcdef0123456789abcdef01234567"
+
+
+class RecordingHandler(Handler):
+    """RecordingHandler
+
+    Handler keeping the paths of the requests in the paths list of the
+    server.
+    """
+
+    def handle_request(self, method):
+        self.server.paths.append(self.path)
+        Handler.handle_request(self, method)
+
+
+class OfflineTest(unittest.TestCase):
+
+    def setUp(self):
+        """setUp"""
+        self.server = FakeNetbox(devices=50, interfaces_per_device=2)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        # Connections are closed after each request, so that no thread of
+        # the server is left waiting on one when the tests end
+        self.api = Api(
+            url=self.server.url,
+            token=TOKEN,
+            keep_alive=False,
+            retry=RetryPolicy(retries=10, backoff_factor=0.001)
+        )
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        """tearDown"""
+        sys.stdout = self.stdout
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+        # Replies may still be written to the connections given up on
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(5)
+
+    def output(self):
+        """
+        Returns what has been displayed, one decoded json value per line.
+        """
+        return [json.loads(l) for l in sys.stdout.getvalue().splitlines()]
+
+    def batch_file(self, operations):
+        """
+        Returns the path of a temporary batch file of operations.
+        """
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        with os.fdopen(fd, 'w') as f:
+            for op in operations:
+                f.write(json.dumps(op) + "\n")
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_batch_retried_operations_succeed(self):
+        """
+        Tests that operations whose requests succeed once retried are
+        reported with the status of their last attempt.
+        """
+        retries = []
+        self.api.add_hook('retry', lambda *args: retries.append(args))
+        self.server.error_rate = 0.3
+        path = self.batch_file([
+            {'action': 'show', 'model': 'dcim', 'obj': 'devices', 'id': i}
+            for i in range(1, 31)
+        ])
+        failed = batch(self.api, file=path)
+        self.assertTrue(retries)
+        self.assertEqual(failed, 0)
+        for res in self.output():
+            self.assertTrue(res['ok'])
+            self.assertEqual(res['status'], 200)
+
+    def test_batch_failed_operations(self):
+        """
+        Tests that operations whose last attempt failed are reported as
+        failed.
+        """
+        path = self.batch_file([
+            {'action': 'show', 'model': 'dcim', 'obj': 'devices', 'id': 1},
+            {'action': 'show', 'model': 'dcim', 'obj': 'devices', 'id': 999},
+        ])
+        failed = batch(self.api, file=path)
+        self.assertEqual(failed, 1)
+        res = self.output()
+        self.assertTrue(res[0]['ok'])
+        self.assertFalse(res[1]['ok'])
+        self.assertEqual(res[1]['status'], 404)
+
+    def test_api_error_unicode(self):
+        """
+        Tests that errors whose detail is not ascii can be displayed.
+        """
+        reply = requests.models.Response()
+        reply.status_code = 404
+        reply.reason = "Not Found"
+        reply.url = "{}/api/dcim/devices/999/".format(self.server.url)
+        reply.encoding = 'utf-8'
+        reply._content = u'{"detail": "Pas trouvé."}'.encode('utf-8')
+        e = ApiError(reply)
+        self.assertEqual(e.detail, u"Pas trouvé.")
+        self.assertIn(u"Pas trouvé.", unicode(e))
+        self.assertIn(u"Pas trouvé.".encode('utf-8'), str(e))
+        reply._content = u"<html>Erreur interne éàü</html>".encode('utf-8') * 50
+        self.assertIn("characters", str(ApiError(reply)))
+
+    def test_get_many_error(self):
+        """
+        Tests that get_many raises ApiError when netbox answers with an
+        error.
+        """
+        self.assertEqual(
+            sorted(get_many(self.api, 'dcim', 'devices', idents=[1, 2])),
+            [1, 2]
+        )
+        self.server.error_rate = 1
+        self.server.error_status = 500
+        with self.assertRaises(ApiError) as ctx:
+            get_many(self.api, 'dcim', 'devices', idents=[1, 2])
+        self.assertEqual(ctx.exception.status_code, 500)
+
+    def test_registry_strings_bounded(self):
+        """
+        Tests that the strings of the objects themselves are not shared by
+        a registry, and that the ones shared are bounded.
+        """
+        registry = Registry(self.api)
+        devices = list(iter_list(self.api, 'dcim', 'devices',
+                                 registry=registry))
+        self.assertEqual(len(devices), 50)
+        # Only the nested objects (site, tenant, role, primary ip) and
+        # choices are shared, not the name, serial, url... of each device
+        self.assertLess(registry.strings, 3 * len(devices))
+        registry = Registry(self.api, max_strings=20)
+        interfaces = list(iter_list(self.api, 'dcim', 'interfaces',
+                                    registry=registry))
+        self.assertEqual(registry.strings, 20)
+        self.assertEqual(interfaces[0].device.name, 'device1')
+
+    def test_plan_shared_key(self):
+        """
+        Tests that plan refuses to match an object by a name several
+        objects have.
+        """
+        for ident in (1, 2):
+            self.api.patch("dcim/devices/{}".format(ident), {'name': 'dup'})
+        with self.assertRaises(ValueError):
+            plan(self.api, 'dcim', 'devices', [{'name': 'dup', 'serial': 'x'}])
+        changes = plan(self.api, 'dcim', 'devices',
+                       [{'id': 1, 'name': 'dup', 'serial': 'x'}])
+        self.assertEqual(changes['patch'], [{'id': 1, 'serial': 'x'}])
+
+    def test_bulk_update_unknown_name(self):
+        """
+        Tests that objects whose name is not found are reported without
+        being sent, and do not make the others fail.
+        """
+        res = bulk_update(self.api, 'dcim', 'devices', [
+            {'name': 'device1', 'serial': 'a'},
+            {'name': 'nosuchdevice', 'serial': 'b'},
+        ])
+        self.assertEqual([r['ok'] for r in res], [True, False])
+        self.assertEqual(res[0]['object']['serial'], 'a')
+        self.assertEqual(res[1]['object']['name'], 'nosuchdevice')
+        with self.assertRaises(ValueError):
+            bulk(self.api, 'dcim', 'devices', 'patch')
+
+    def test_timeout_retried(self):
+        """
+        Tests that requests the server does not answer in time are sent
+        again, then fail.
+        """
+        api = Api(url=self.server.url, token=TOKEN, keep_alive=False,
+                  timeout=0.05, retry=RetryPolicy(retries=2, jitter=False,
+                                                  backoff_factor=0.001))
+        retries = []
+        api.add_hook('retry', lambda *args: retries.append(args))
+        self.server.latency = 200
+        # The replies are written to connections closed by the client
+        self.server.handle_error = lambda request, client_address: None
+        with self.assertRaises(requests.exceptions.Timeout):
+            api.get("dcim/devices/1")
+        self.assertEqual(len(retries), 2)
+        api.close()
+
+    def test_retry_after_capped(self):
+        """
+        Tests that the delay asked by Retry-After is capped by
+        max_backoff.
+        """
+        reply = requests.models.Response()
+        reply.status_code = 503
+        reply.headers['Retry-After'] = '3600'
+        self.assertEqual(RetryPolicy(max_backoff=5).delay(0, reply), 5)
+        reply.headers['Retry-After'] = '2'
+        self.assertEqual(RetryPolicy(max_backoff=5).delay(0, reply), 2)
+
+    def test_response_cache_skips_pages(self):
+        """
+        Tests that objects are read once through the response cache, and
+        pages of lists every time.
+        """
+        api = Api(url=self.server.url, token=TOKEN, keep_alive=False,
+                  response_cache=ResponseCache(ttl=60))
+        sent = []
+        api.add_hook('pre_request', lambda *args: sent.append(args[1]))
+        for i in range(2):
+            api.get("dcim/devices/1")
+            list(iter_list(api, 'dcim', 'devices', page_size=20))
+        self.assertEqual(len(sent), 1 + 2 * 3)
+        api.close()
+
+    def test_write_json_atomic_threads(self):
+        """
+        Tests that threads can write the same json file at the same time.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'cache', 'names.json')
+        errors = []
+
+        def write(i):
+            try:
+                for j in range(50):
+                    write_json_atomic(path, {'thread': i, 'write': j})
+            except (IOError, OSError) as e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(read_json(path)['write'], 49)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['names.json'])
+
+    def test_metrics_retries(self):
+        """
+        Tests that metrics count the requests, their status and the
+        retries.
+        """
+        metrics = Metrics(self.api)
+        self.server.error_rate = 0.3
+        for ident in range(1, 21):
+            self.api.get("dcim/devices/{}".format(ident))
+        stats = metrics.stats[('GET', 'dcim/devices/{id}')]
+        self.assertEqual(stats['status']['200'], 20)
+        self.assertEqual(stats['status'].get('503', 0), stats['retries'])
+        self.assertEqual(stats['count'], 20 + stats['retries'])
+        self.assertIn('dcim/devices/{id}', metrics.summary())
+        self.assertIn(
+            'netboxapi_requests_total{method="GET",endpoint="dcim/devices/{id}",'
+            'status="200"} 20', metrics.prometheus()
+        )
+
+    def test_sync_deltas(self):
+        """
+        Tests that sync only fetches the objects changed since the last
+        synchronization, and drops the deleted ones.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with SnapshotStore(os.path.join(directory, 's.sqlite')) as store:
+            self.assertEqual(
+                sync(self.api, 'dcim', 'devices', store)['updated'], 50
+            )
+            self.api.patch("dcim/devices/3", {'serial': 'first'})
+            sync(self.api, 'dcim', 'devices', store)
+            self.api.patch("dcim/devices/4", {'serial': 'second'})
+            res = sync(self.api, 'dcim', 'devices', store)
+            # Objects changed during the same second as the high water
+            # mark are fetched again
+            self.assertIn(res['updated'], (1, 2))
+            self.assertEqual(res['deleted'], 0)
+            self.assertEqual(store.get('dcim/devices', 4)['serial'], 'second')
+            self.api.delete("dcim/devices/5/")
+            res = sync(self.api, 'dcim', 'devices', store)
+            self.assertEqual(res['deleted'], 1)
+            self.assertIsNone(store.get('dcim/devices', 5))
+            self.assertEqual(store.count('dcim/devices'), 49)
+
+    def test_codec_round_trip(self):
+        """
+        Tests that objects are decoded as they have been encoded, whatever
+        the json library used.
+        """
+        elmt = {
+            u'name': u'sw\xe9-1/0', u'id': 3, u'weight': 1.5,
+            u'tags': [], u'tenant': None, u'enabled': False,
+            u'custom_fields': {u'a b': [1, {u'c': u'd'}]},
+        }
+        self.assertEqual(loads(dumps(elmt)), elmt)
+        self.assertEqual(loads(dumps(elmt, pretty=True)), elmt)
+        self.assertEqual(dumps(elmt, pretty=True),
+                         dumps(loads(dumps(elmt)), pretty=True))
+        with self.assertRaises(ValueError):
+            loads('')
+
+    def test_async_api(self):
+        """
+        Tests that asynchronous requests return the objects asked for.
+        """
+        with AsyncApi(concurrency=4, url=self.server.url, token=TOKEN,
+                      keep_alive=False) as api:
+            pending = [get_async(api, 'dcim', 'devices', ident=i)
+                       for i in range(1, 11)]
+            devices = [p.get() for p in pending]
+        self.assertEqual([d['id'] for d in devices], range(1, 11))
+
+    def test_cli_sends_one_request(self):
+        """
+        Tests that the command line only sends the request asked for when
+        it names the app, the endpoint and the action, the schema not
+        being discovered.
+        """
+        self.server.RequestHandlerClass = RecordingHandler
+        self.server.paths = []
+        for key, value in (('NETBOXAPI_URL', self.server.url),
+                           ('NETBOXAPI_TOKEN', TOKEN)):
+            if key in os.environ:
+                self.addCleanup(os.environ.__setitem__, key, os.environ[key])
+            else:
+                self.addCleanup(os.environ.pop, key)
+            os.environ[key] = value
+        self.addCleanup(setattr, sys, 'argv', sys.argv)
+        self.addCleanup(setattr, sys, 'stderr', sys.stderr)
+        sys.stderr = StringIO()
+        sys.argv = ['netboxapi-client', '--no-schema-cache', 'dcim',
+                    'devices', 'show', '-i', '7']
+        main()
+        self.assertEqual(self.server.paths, ['/api/dcim/devices/7'])
+        self.assertEqual(json.loads(sys.stdout.getvalue())['id'], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()